@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import time
+
+import codec
+import recording
+
+# compares gateway codecs on a recording made with record_gateway. ETF payloads are made by
+# re-encoding the recorded JSON
+
+def main():
+	parser = argparse.ArgumentParser(description='benchmark gateway codecs on a recording')
+	parser.add_argument('recording')
+	parser.add_argument('--rounds', type=int, default=5)
+	args = parser.parse_args()
+
+	payloads = [raw_data for _, raw_data in recording.read(args.recording)]
+	if not payloads:
+		parser.error('%s has no payloads' % args.recording)
+	etf_payloads = [codec.EtfCodec.encode(json.loads(raw_data)) for raw_data in payloads]
+
+	candidates = [('json (stdlib)', json.loads, payloads)]
+	if codec.orjson is not None:
+		candidates.append(('json (orjson)', codec.orjson.loads, payloads))
+	candidates.append(('etf (pure python)', codec.EtfCodec.decode, etf_payloads))
+
+	print('%d payloads' % len(payloads))
+	for name, decode, raw in candidates:
+		size = sum(len(r) for r in raw)
+		best = float('inf')
+		for _ in range(args.rounds):
+			start = time.perf_counter()
+			for r in raw:
+				decode(r)
+			best = min(best, time.perf_counter() - start)
+		print('%-18s %8.1f MB %9.2f us/payload %8.1f MB/s' % (
+				name, size / 1e6, best / len(raw) * 1e6, size / best / 1e6))
+
+if __name__ == '__main__':
+	main()
@@ -1,161 +1,380 @@
-from collections import defaultdict
-import copy
-import datetime
-import imp
-import json
-import os
+import asyncio
+import random
+import struct
 import sys
-import threading
 import time
 import traceback
 import zlib
-import _thread
 
+import aiohttp
 import requests
-import websocket
 
+import codec
 import config
+from dispatch import Dispatcher
+from errors import ErrorAggregator
+import guilds
 import log
-from utils import readable_rel
+import metrics
+import recording
+from reloader import Reloader
+import rest
+import timers
 import warframe
+import zkill
 
 class Bot:
-	def __init__(self, commands):
+	def __init__(self, commands, shard_id=0, shard_count=1):
+		self.shard_id = shard_id
+		self.shard_count = shard_count
+		self.loop = asyncio.get_event_loop()
 		self.ws = None
-		self.rs = requests.Session()
-		self.rs.headers['Authorization'] = 'Bot ' + config.bot.token
-		self.rs.headers['User-Agent'] = 'DiscordBot (https://github.com/raylu/sbot 0.0'
-		self.heartbeat_thread = None
-		self.timer_thread = None
-		self.timer_condvar = threading.Condition()
-		self.zkill_thread = None
-		self.warframe_thread = None
+		self.session = None # aiohttp.ClientSession, created on the loop in connect()
+		self.codec = codec.get(config.bot.gateway_encoding)
+		self.ratelimiter = rest.RateLimiter()
+		self.outbox = rest.Outbox(self)
+		metrics.Gauge('sbot_outbox_depth', 'messages waiting to be sent', func=self.outbox.depth)
+		self.inflator = None # zlib-stream decompressor, one per connection
+		self.inflated = bytearray()
+		self.headers = {
+			'Authorization': 'Bot ' + config.bot.token,
+			'User-Agent': 'DiscordBot (https://github.com/raylu/sbot 0.0',
+		}
+		# commands still make blocking calls (requests, sqlite, subprocess) so they run on the
+		# dispatcher's threads, off the event loop
+		self.dispatcher = Dispatcher(self)
+		self.errors = ErrorAggregator(self)
+		self.errors_task = None
+		self.heartbeat_task = None
+		self.heartbeat_acked = True
+		self.heartbeat_sent = None
+		self.metrics_server = None
+		self.timers = timers.Scheduler(self)
+		self.timer_task = None
+		self.zkill = None
+		self.zkill_task = None
+		self.warframe_task = None
 		self.user_id = None
+		self.session_id = None
 		self.seq = None
-		self.guilds = {} # guild id -> Guild
-		self.channels = {} # channel id -> guild id
+		# only guilds on this shard
+		self.cache = guilds.Cache()
+		self.guilds = self.cache.guilds # guild id -> guilds.Guild
+		self.channels = self.cache.channels # channel id -> guild id
 
 
 		self.handlers = {
 			OP.HELLO: self.handle_hello,
 			OP.DISPATCH: self.handle_dispatch,
+			OP.HEARTBEAT: self.handle_heartbeat,
+			OP.HEARTBEAT_ACK: self.handle_heartbeat_ack,
+			OP.RECONNECT: self.handle_reconnect,
+			OP.INVALID_SESSION: self.handle_invalid_session,
 		}
 		self.events = {
 			'READY': self.handle_ready,
+			'RESUMED': self.handle_resumed,
 			'MESSAGE_CREATE': self.handle_message_create,
 			'GUILD_CREATE': self.handle_guild_create,
-			'GUILD_MEMBER_ADD': self.handle_guild_member_add
+			'GUILD_UPDATE': self.handle_cache_event(self.cache.guild_update),
+			'GUILD_DELETE': self.handle_cache_event(self.cache.guild_delete),
+			'GUILD_ROLE_CREATE': self.handle_cache_event(self.cache.role_create),
+			'GUILD_ROLE_UPDATE': self.handle_cache_event(self.cache.role_update),
+			'GUILD_ROLE_DELETE': self.handle_cache_event(self.cache.role_delete),
+			'CHANNEL_CREATE': self.handle_cache_event(self.cache.channel_create),
+			'CHANNEL_DELETE': self.handle_cache_event(self.cache.channel_delete),
+			'GUILD_MEMBER_ADD': self.handle_guild_member_add,
 		}
 		self.commands = commands
-
+		self.reloader = None
+		self.reloader_task = None
+		self.recorder = None
+		if config.bot.record_gateway is not None:
+			self.recorder = recording.Recorder(config.bot.record_gateway)
 		if config.bot.autoreload:
-			self.mtimes = {}
-			self.modules = defaultdict(list)
-			for trigger, handler in commands.items():
-				module_name = handler.__module__
-				module = sys.modules[module_name]
-				path = module.__file__
-				if module_name not in self.mtimes:
-					self.mtimes[module_name] = os.stat(path).st_mtime
-				self.modules[module_name].append(trigger)
+			self.reloader = Reloader(self)
 
 	def connect(self):
+		self.loop.run_until_complete(self._connect())
+
+	async def _connect(self):
+		if self.session is None:
+			self.session = aiohttp.ClientSession()
+		self.dispatcher.start()
+		if self.errors_task is None:
+			self.errors_task = self.spawn(self.errors.run())
+		if self.reloader is not None and self.reloader_task is None:
+			self.reloader_task = self.spawn(self.reloader.run())
+		if config.bot.metrics_port is not None and self.metrics_server is None:
+			# one port per shard process
+			self.metrics_server = await metrics.serve(config.bot.metrics_port + self.shard_id)
 		if config.state.gateway_url is None:
-			data = self.get('/gateway/bot')
+			data = await self.request('GET', '/gateway/bot')
 			config.state.gateway_url = data['url']
-			config.state.save()
 
-		url = config.state.gateway_url + '?v=6&encoding=json'
-		self.ws = websocket.create_connection(url)
+		url = config.state.gateway_url + '?v=6&encoding=' + self.codec.name
+		if config.bot.gateway_compress == 'zlib-stream':
+			# the whole connection is one zlib stream, so the inflate context (and its window) is
+			# shared across payloads instead of being rebuilt for every GUILD_CREATE
+			url += '&compress=zlib-stream'
+			self.inflator = zlib.decompressobj()
+		else:
+			self.inflator = None
+		del self.inflated[:]
+		# GUILD_CREATE for large guilds can exceed aiohttp's default 4 MB limit
+		self.ws = await self.session.ws_connect(url, max_msg_size=0)
 
 	def run_forever(self):
+		try:
+			self.loop.run_until_complete(self._supervise())
+		finally:
+			self.loop.run_until_complete(self.session.close())
+			self.dispatcher.executor.shutdown(wait=False)
+			if self.recorder is not None:
+				self.recorder.close()
+
+	async def _supervise(self):
+		failures = 0
+		while True:
+			connected_at = time.monotonic()
+			try:
+				if self.ws is None:
+					await self._connect()
+				await self._receive_loop()
+			except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+				log.write('gateway: %r' % e)
+			except DECODE_ERRORS as e:
+				# a corrupt or cut off frame; the next connection starts a fresh zlib stream
+				log.write('gateway: undecodable payload: %r' % e)
+			close_code = await self._disconnect()
+			if close_code in FATAL_CLOSE_CODES:
+				raise FatalGatewayError('gateway closed with %d' % close_code)
+			if close_code in (4007, 4009): # invalid seq, session timed out
+				self.session_id = None
+
+			if time.monotonic() - connected_at > 60:
+				failures = 0
+			failures += 1
+			# full jitter so that a discord outage doesn't have every bot reconnect in lockstep
+			delay = random.uniform(0, min(60, 2 ** failures))
+			log.write('reconnecting in %.1fs (%s)' % (delay, 'resume' if self.session_id else 'identify'))
+			await asyncio.sleep(delay)
+
+	async def _disconnect(self):
+		if self.heartbeat_task is not None:
+			self.heartbeat_task.cancel()
+			self.heartbeat_task = None
+		close_code = None
+		if self.ws is not None:
+			await self.ws.close(code=RESUME_CLOSE_CODE)
+			close_code = self.ws.close_code
+			self.ws = None
+		return close_code
+
+	async def _receive_loop(self):
 		while True:
-			raw_data = self.ws.recv()
-			# one might think that after sending "compress": true, we can expect to only receive
-			# compressed data. one would be underestimating discord's incompetence
-			if isinstance(raw_data, bytes):
-				raw_data = zlib.decompress(raw_data).decode('utf-8')
+			msg = await self.ws.receive()
+			if msg.type == aiohttp.WSMsgType.BINARY and self.inflator is not None:
+				# a payload may span several frames; only the last one ends with the sync flush
+				self.inflated.extend(self.inflator.decompress(msg.data))
+				if msg.data[-4:] != ZLIB_SUFFIX:
+					continue
+				raw_data = bytes(self.inflated)
+				del self.inflated[:]
+			elif msg.type == aiohttp.WSMsgType.BINARY and msg.data[0] == codec.VERSION:
+				raw_data = msg.data # uncompressed ETF
+			elif msg.type == aiohttp.WSMsgType.BINARY:
+				# one might think that after sending "compress": true, we can expect to only receive
+				# compressed data. one would be underestimating discord's incompetence
+				raw_data = zlib.decompress(msg.data)
+			elif msg.type == aiohttp.WSMsgType.TEXT:
+				raw_data = msg.data
+			else:
+				log.write('websocket closed: %s %s' % (msg.type, msg.data))
+				break
 			if not raw_data:
 				break
+			# most messages aren't commands; skip decoding those when the raw payload says as much
+			skipped_seq = self.codec.skippable(raw_data) if config.bot.gateway_prefilter else None
+			data = None
+			if skipped_seq is None:
+				data = self.codec.decode(raw_data)
 			if config.bot.debug:
-				print('<-', raw_data)
-			data = json.loads(raw_data)
-			self.seq = data['s']
+				print('<-', self.codec.text(raw_data, data))
+			if self.recorder is not None:
+				# recordings are always JSON so they replay (and benchmark) with any codec
+				if self.codec.binary:
+					self.recorder.write(codec.JsonCodec.encode(data))
+				else:
+					self.recorder.write(codec.JsonCodec.text(raw_data))
+			if skipped_seq is not None:
+				self.seq = skipped_seq
+				metrics.gateway_events.inc('MESSAGE_CREATE')
+				metrics.gateway_prefiltered.inc()
+				continue
+			if data['s'] is not None:
+				self.seq = data['s']
 			handler = self.handlers.get(data['op'])
 			if handler:
 				try:
-					handler(data['t'], data['d'])
+					await handler(data['t'], data['d'])
 				except:
-					tb = traceback.format_exc()
-					log.write(data)
-					log.write(tb)
-					if config.bot.err_channel:
-						try:
-							# messages can be up to 2000 characters
-							self.send_message(config.bot.err_channel,
-									'```\n%s\n```\n```\n%s\n```' % (raw_data[:800], tb[:1000]))
-						except Exception:
-							log.write('error sending to err_channel:\n' + traceback.format_exc())
+					self.report_error(self.codec.text(raw_data, data))
 
-	def get(self, path):
-		response = self.rs.get('https://discordapp.com/api' + path)
-		response.raise_for_status()
-		return response.json()
+	def report_error(self, raw_data):
+		# call from an except block
+		self.errors.report(raw_data, *sys.exc_info())
 
-	def post(self, path, data, method='POST'):
-		if config.bot.debug:
+	def spawn(self, coro):
+		task = asyncio.ensure_future(coro, loop=self.loop)
+		task.add_done_callback(self._task_done)
+		return task
+
+	@staticmethod
+	def _task_done(task):
+		if task.cancelled():
+			return
+		e = task.exception()
+		if e is not None:
+			log.write('error in background task:\n' +
+					''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+	async def request(self, method, path, data=None):
+		if config.bot.debug and method != 'GET':
 			print('=>', path, data)
-		response = self.rs.request(method, 'https://discordapp.com/api' + path, json=data)
-		response.raise_for_status()
-		if response.status_code != 204: # No Content
-			return response.json()
-		return None
-
-	def send(self, op, d):
-		raw_data = json.dumps({'op': op, 'd': d})
-		if config.bot.debug:
-			print('->', raw_data)
-		self.ws.send(raw_data)
+		route = rest.Route(method, path)
+		while True:
+			bucket = await self.ratelimiter.acquire(route)
+			start = time.monotonic()
+			try:
+				async with self.session.request(method, config.bot.api_url + path,
+						json=data, headers=self.headers) as response:
+					metrics.rest_seconds.observe(time.monotonic() - start, route.key, response.status)
+					self.ratelimiter.update(route, bucket, response.headers)
+					if response.status == 429:
+						self.ratelimiter.limited(route, bucket, response.headers, await response.json())
+						continue
+					response.raise_for_status()
+					if response.status != 204: # No Content
+						return await response.json()
+					return None
+			finally:
+				bucket.release()
 
-	def send_message(self, channel_id, text, embed=None):
+	async def create_message(self, channel_id, text, embed=None):
 		data = {'content': text}
 		if embed is not None:
 			data['embed'] = embed
-		self.post('/channels/%s/messages' % channel_id, data)
+		await self.outbox.put(channel_id, data)
+
+	# get, post and send_message are for commands, which run on executor threads. they block the
+	# calling thread until the request completes on the event loop. never call them from the loop
+	def get(self, path):
+		return self._run_threadsafe(self.request('GET', path))
+
+	def post(self, path, data, method='POST'):
+		return self._run_threadsafe(self.request(method, path, data))
 
-	def handle_hello(self, _, d):
+	def send_message(self, channel_id, text, embed=None):
+		self._run_threadsafe(self.create_message(channel_id, text, embed))
+
+	def _run_threadsafe(self, coro):
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+	async def send(self, op, d):
+		raw_data = self.codec.encode({'op': op, 'd': d})
+		if config.bot.debug:
+			print('->', self.codec.text(raw_data))
+		if self.codec.binary:
+			await self.ws.send_bytes(raw_data)
+		else:
+			await self.ws.send_str(raw_data)
+
+	async def handle_hello(self, _, d):
 		log.write('connected to %s' % d['_trace'])
-		self.heartbeat_thread = _thread.start_new_thread(self.heartbeat_loop, (d['heartbeat_interval'],))
-		self.send(OP.IDENTIFY, {
+		self.heartbeat_acked = True
+		self.heartbeat_task = self.spawn(self.heartbeat_loop(d['heartbeat_interval']))
+		if self.session_id is not None:
+			# discord replays everything after seq, so the caches stay as they are
+			await self.send(OP.RESUME, {
+				'token': config.bot.token,
+				'session_id': self.session_id,
+				'seq': self.seq,
+			})
+		else:
+			await self.identify()
+
+	async def identify(self):
+		await self.send(OP.IDENTIFY, {
 			'token': config.bot.token,
 			'properties': {
 				'$browser': 'github.com/raylu/sbot',
 				'$device': 'github.com/raylu/sbot',
 			},
-			'compress': True,
+			# per-payload compression; redundant with (and not allowed alongside) zlib-stream
+			'compress': self.inflator is None,
+			'intents': config.bot.intents if config.bot.intents is not None else default_intents(),
 			'large_threshold': 50,
-			'shard': [0, 1]
+			'shard': [self.shard_id, self.shard_count],
 		})
 
-	def handle_dispatch(self, event, d):
+	async def handle_heartbeat(self, _, d):
+		await self.send(OP.HEARTBEAT, self.seq)
+
+	async def handle_heartbeat_ack(self, _, d):
+		self.heartbeat_acked = True
+		if self.heartbeat_sent is not None:
+			metrics.heartbeat_rtt.observe(time.monotonic() - self.heartbeat_sent)
+			self.heartbeat_sent = None
+
+	async def handle_reconnect(self, _, d):
+		log.write('gateway asked us to reconnect')
+		await self.ws.close(code=RESUME_CLOSE_CODE)
+
+	async def handle_invalid_session(self, _, resumable):
+		log.write('invalid session (resumable: %s)' % resumable)
+		# discord wants a random 1-5 second wait before the next IDENTIFY
+		await asyncio.sleep(random.uniform(1, 5))
+		if resumable:
+			await self.send(OP.RESUME, {
+				'token': config.bot.token,
+				'session_id': self.session_id,
+				'seq': self.seq,
+			})
+		else:
+			self.session_id = None
+			self.seq = None
+			await self.identify()
+
+	async def handle_dispatch(self, event, d):
+		metrics.gateway_events.inc(event)
 		handler = self.events.get(event)
 		if handler:
-			handler(d)
+			await handler(d)
 
-	def handle_ready(self, d):
-		log.write('connected as ' + d['user']['username'])
+	async def handle_ready(self, d):
+		log.write('connected as %s (shard %d/%d)' % (d['user']['username'], self.shard_id, self.shard_count))
 		self.user_id = d['user']['id']
-		self.timer_thread = _thread.start_new_thread(self.timer_loop, ())
-		if config.bot.zkillboard is not None:
-			self.zkill_thread = _thread.start_new_thread(self.zkill_loop, ())
-		if config.bot.warframe is not None:
-			self.warframe_thread = _thread.start_new_thread(self.warframe_loop, ())
+		self.session_id = d['session_id']
+		# a new session after an invalid one sends READY again; the pollers are still running.
+		# with several shards, only the first one posts kills and alerts
+		if self.shard_id != 0:
+			return
+		if config.bot.zkillboard is not None and self.zkill_task is None:
+			self.zkill = zkill.Subscriptions(self, config.bot.zkillboard)
+			self.zkill_task = self.spawn(self.zkill_loop())
+			self.spawn(self.zkill.run())
+		if config.bot.warframe is not None and self.warframe_task is None:
+			self.warframe_task = self.spawn(self.warframe_loop())
+
+	async def handle_resumed(self, d):
+		log.write('resumed session at seq %s' % self.seq)
 
-	def handle_message_create(self, d):
+	async def handle_message_create(self, d):
 		content = d['content']
 		if content == 'oh no.':
-			cmd = CommandEvent(d['channel_id'], d['author'], None, self)
-			self.commands['ohno'](cmd)
+			cmd = CommandEvent(d['channel_id'], d['author'], None, self, d.get('guild_id'))
+			self.dispatcher.submit('ohno', self.commands['ohno'], cmd, d)
 			return
 		if not content.startswith('!'):
 			return
@@ -164,135 +383,99 @@ class Bot:
 		split = lines[0].split(' ', 1)
 		handler = self.commands.get(split[0])
 		if handler:
-			if config.bot.autoreload:
-				module_name = handler.__module__
-				module = sys.modules[module_name]
-				path = module.__file__
-				new_mtime = os.stat(path).st_mtime
-				if new_mtime > self.mtimes[module_name]:
-					imp.reload(module)
-					self.mtimes[module_name] = new_mtime
-					for trigger in self.modules[module_name]:
-						handler_name = self.commands[trigger].__name__
-						self.commands[trigger] = getattr(module, handler_name)
-						if trigger == split[0]:
-							handler = self.commands[trigger]
-
 			arg = ''
 			if len(split) == 2:
 				arg = split[1]
 			if len(lines) == 2:
 				arg += '\n' + lines[1]
-			cmd = CommandEvent(d['channel_id'], d['author'], arg, self)
-			handler(cmd)
+			cmd = CommandEvent(d['channel_id'], d['author'], arg, self, d.get('guild_id'))
+			self.dispatcher.submit(split[0], handler, cmd, d)
 
-	def handle_guild_create(self, d):
-		self.guilds[d['id']] = Guild(d)
-		for channel in d['channels']:
-			self.channels[channel['id']] = d['id']
+	async def handle_guild_create(self, d):
+		self.cache.guild_create(d)
+		# each shard runs the timers for the channels it has
+		self.timers.load(channel['id'] for channel in d.get('channels', ()))
+		if self.timer_task is None:
+			self.timer_task = self.spawn(self.timers.run())
 
-	def handle_guild_member_add(self, d):
+	@staticmethod
+	def handle_cache_event(update):
+		async def handler(d):
+			update(d)
+		return handler
+
+	async def handle_guild_member_add(self, d):
 		guild_id = d['guild_id']
 		if guild_id != config.bot.role_server or d['user'].get('bot'):
 			return
 		user_id = d['user']['id']
-		humans_role_id = self.guilds[guild_id].roles['humans']['id']
-		self.post('/guilds/%s/members/%s/roles/%s' % (guild_id, user_id, humans_role_id), None,
-				method='PUT')
+		humans_role_id = self.guilds[guild_id].roles['humans'].id
+		self.spawn(self.request('PUT', '/guilds/%s/members/%s/roles/%s' % (guild_id, user_id, humans_role_id)))
 
-	def heartbeat_loop(self, interval_ms):
+	async def heartbeat_loop(self, interval_ms):
 		interval_s = interval_ms / 1000
 		while True:
-			time.sleep(interval_s)
-			self.send(OP.HEARTBEAT, self.seq)
+			await asyncio.sleep(interval_s)
+			if not self.heartbeat_acked:
+				# zombied connection; drop it and resume on a new one
+				log.write('no heartbeat ack, reconnecting')
+				await self.ws.close(code=RESUME_CLOSE_CODE)
+				return
+			self.heartbeat_acked = False
+			self.heartbeat_sent = time.monotonic()
+			await self.send(OP.HEARTBEAT, self.seq)
 
-	def timer_loop(self):
-		while True:
-			wakeups = []
-			now = datetime.datetime.utcnow()
-			hour_from_now = now + datetime.timedelta(hours=1)
-			for name, dt in copy.copy(config.state.timers).items():
-				if dt <= now:
-					self.send_message(config.bot.timer_channel, 'removing expired timer "%s" for %s' %
-							(name, dt.strftime('%Y-%m-%d %H:%M:%S')))
-					del config.state.timers[name]
-					config.state.save()
-				elif dt <= hour_from_now:
-					self.send_message(config.bot.timer_channel, '%s until %s' % (readable_rel(dt - now), name))
-					wakeups.append(dt)
-				else:
-					wakeups.append(dt - datetime.timedelta(hours=1))
-			wakeup = None
-			if wakeups:
-				wakeups.sort()
-				wakeup = (wakeups[0] - now).total_seconds()
-			with self.timer_condvar:
-				self.timer_condvar.wait(wakeup)
-
-	def zkill_loop(self):
+	async def zkill_loop(self):
 		while True:
-			r = self.rs.get('https://redisq.zkillboard.com/listen.php', params={'ttw': 30})
-			if r.ok:
-				data = r.json()
-				if not data or not data['package']:
-					time.sleep(10)
-					continue
-				killmail = data['package']['killmail']
-				victim = killmail['victim']
-
-				characters = killmail['attackers']
-				characters.append(victim)
-				for char in characters:
-					if 'alliance' in char and char['alliance']['id'] == config.bot.zkillboard['alliance']:
-						break
-				else: # alliance not involved in kill
-					continue
+			try:
+				data = await self._zkill_listen()
+			except aiohttp.ClientError as e:
+				log.write('zkill: %r' % e)
+				data = None
+			if data is None:
+				await asyncio.sleep(30)
+				continue
+			if not data['package']:
+				await asyncio.sleep(10)
+				continue
+			with metrics.Timer(metrics.poller_seconds, 'zkill'):
+				self.zkill.post(data)
 
-				if 'character' not in victim:
-					continue
-				victim_name = victim['character']['name']
-				ship = victim['shipType']['name']
-				cost = data['package']['zkb']['totalValue'] / 1000000
-				url = 'https://zkillboard.com/kill/%d/' % killmail['killID']
-				self.send_message(config.bot.zkillboard['channel'],
-						"%s's **%s** (%d mil) %s" % (victim_name, ship, cost, url))
-			else:
-				log.write('zkill: %s %s\n%s' % (r.status_code, r.reason, r.text[:1000]))
-				time.sleep(30)
+	async def _zkill_listen(self):
+		async with self.session.get('https://redisq.zkillboard.com/listen.php', params={'ttw': 30}) as r:
+			if r.status != 200:
+				text = await r.text()
+				log.write('zkill: %s %s\n%s' % (r.status, r.reason, text[:1000]))
+				return None
+			data = await r.json(content_type=None)
+		return data or {'package': None}
 
-	def warframe_loop(self):
+	async def warframe_loop(self):
 		last_alerts = []
 		while True:
-			time.sleep(5 * 60)
+			await asyncio.sleep(5 * 60)
 			try:
-				alerts = warframe.alert_analysis()
-				broadcast_alerts = set(alerts) - set(last_alerts)
-				if len(broadcast_alerts) > 0:
-					self.send_message(config.bot.warframe['channel'], '\n'.join(broadcast_alerts))
+				with metrics.Timer(metrics.poller_seconds, 'warframe'):
+					# warframe uses requests, so keep it off the loop
+					alerts = await self.loop.run_in_executor(None, warframe.alert_analysis)
+					broadcast_alerts = set(alerts) - set(last_alerts)
+					if len(broadcast_alerts) > 0:
+						await self.create_message(config.bot.warframe['channel'], '\n'.join(broadcast_alerts))
 				last_alerts = alerts
 			except requests.exceptions.HTTPError as e:
 				log.write('warframe: %s\n%s' % (e, e.response.text[:1000]))
 			except requests.exceptions.RequestException as e:
 				log.write('warframe: %s' % e)
+			except aiohttp.ClientError as e:
+				log.write('warframe: posting alerts: %r' % e)
 
-class Guild:
-	def __init__(self, d):
-		self.roles = {} # name -> {
-		#	'color': 0,
-		#	'hoist': False,
-		#	'id': '282441120896516096',
-		#	'managed': True,
-		#	'mentionable': False,
-		#	'name': 'sbot',
-		#	'permissions': 805637184,
-		#	'position': 5,
-		# }
-		for role in d['roles']:
-			self.roles[role['name']] = role
+class FatalGatewayError(Exception):
+	pass
 
 class CommandEvent:
-	def __init__(self, channel_id, sender, args, bot):
+	def __init__(self, channel_id, sender, args, bot, guild_id=None):
 		self.channel_id = channel_id
+		self.guild_id = guild_id # None in DMs
 		# sender = {
 		#     'username': 'raylu',
 		#     'id': '109405765848088576',
@@ -302,10 +485,48 @@ class CommandEvent:
 		self.sender = sender
 		self.args = args
 		self.bot = bot
+		self.cancelled = False # set by the dispatcher when the command runs past its deadline
 
 	def reply(self, message, embed=None):
+		if self.cancelled:
+			return
 		self.bot.send_message(self.channel_id, message, embed)
 
+ZLIB_SUFFIX = b'\x00\x00\xff\xff'
+# what inflating a damaged stream or decoding a bad JSON or ETF payload raises
+DECODE_ERRORS = (zlib.error, ValueError, IndexError, struct.error)
+# authentication failed, invalid shard, sharding required, invalid API version, invalid intents,
+# disallowed intents (a privileged one that isn't enabled for the app)
+FATAL_CLOSE_CODES = (4004, 4010, 4011, 4012, 4013, 4014)
+# discord invalidates the session when we close with 1000 or 1001, which is aiohttp's default
+RESUME_CLOSE_CODE = 4000
+
+class INTENT: # pylint: disable=bad-whitespace
+	GUILDS                   = 1 << 0
+	GUILD_MEMBERS            = 1 << 1 # privileged; has to be enabled for the app
+	GUILD_BANS               = 1 << 2
+	GUILD_EMOJIS             = 1 << 3
+	GUILD_INTEGRATIONS       = 1 << 4
+	GUILD_WEBHOOKS           = 1 << 5
+	GUILD_INVITES            = 1 << 6
+	GUILD_VOICE_STATES       = 1 << 7
+	GUILD_PRESENCES          = 1 << 8 # privileged
+	GUILD_MESSAGES           = 1 << 9
+	GUILD_MESSAGE_REACTIONS  = 1 << 10
+	GUILD_MESSAGE_TYPING     = 1 << 11
+	DIRECT_MESSAGES          = 1 << 12
+	DIRECT_MESSAGE_REACTIONS = 1 << 13
+	DIRECT_MESSAGE_TYPING    = 1 << 14
+
+def default_intents():
+	# guilds, roles and channels for the cache and guild and direct messages for commands. no
+	# presences or typing, which are most of the traffic in big guilds. member joins are only for
+	# role_server's humans role, and they're privileged, so they're only asked for when it's set
+	intents = INTENT.GUILDS | INTENT.GUILD_MESSAGES | INTENT.DIRECT_MESSAGES
+	if config.bot.role_server is not None:
+		intents |= INTENT.GUILD_MEMBERS
+	return intents
+
 class OP: # pylint: disable=bad-whitespace
 	DISPATCH              = 0
 	HEARTBEAT             = 1
@@ -0,0 +1,254 @@
+import json
+import re
+import struct
+import zlib
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+# gateway payload codecs, picked with gateway_encoding in config.yaml. decode takes whatever came
+# off the socket (str, or bytes after inflating), encode returns what to send back
+
+class JsonCodec:
+	name = 'json'
+	binary = False
+
+	@staticmethod
+	def decode(raw_data):
+		if orjson is not None:
+			return orjson.loads(raw_data)
+		if isinstance(raw_data, bytes):
+			raw_data = raw_data.decode('utf-8')
+		return json.loads(raw_data)
+
+	@staticmethod
+	def encode(data):
+		if orjson is not None:
+			return orjson.dumps(data).decode('utf-8')
+		return json.dumps(data)
+
+	@staticmethod
+	def text(raw_data, data=None):
+		if isinstance(raw_data, bytes):
+			return raw_data.decode('utf-8', 'replace')
+		return raw_data
+
+	@staticmethod
+	def skippable(raw_data):
+		# returns the seq of a MESSAGE_CREATE that can't be a command (content starting with ! or
+		# exactly "oh no."), or None if the payload needs a full decode. discord puts t and s before
+		# d; any other layout just gets decoded. '!' is never escaped in JSON, so a command's
+		# content always starts with the literal bytes matched here
+		patterns = prefilter_bytes if isinstance(raw_data, bytes) else prefilter_str
+		header_end = raw_data.find(patterns.d_key)
+		if header_end == -1:
+			return None
+		header = raw_data[:header_end]
+		if patterns.message_create not in header:
+			return None
+		match = patterns.seq.search(header)
+		if match is None or patterns.command.search(raw_data, header_end):
+			return None
+		return int(match.group(1))
+
+class EtfCodec:
+	# erlang's external term format, as sent by the gateway with encoding=etf. pure python, so it
+	# mostly pays off in bandwidth; see bench_codec.py
+	name = 'etf'
+	binary = True
+
+	@staticmethod
+	def decode(raw_data):
+		if raw_data[0] != VERSION:
+			raise ValueError('not an ETF payload: %r' % raw_data[:8])
+		value, _ = _decode_term(raw_data, 1)
+		return value
+
+	@staticmethod
+	def encode(data):
+		out = bytearray([VERSION])
+		_encode_term(data, out)
+		return bytes(out)
+
+	@staticmethod
+	def skippable(raw_data):
+		return None
+
+	@staticmethod
+	def text(raw_data, data=None):
+		if data is None:
+			try:
+				data = EtfCodec.decode(raw_data)
+			except Exception:
+				return repr(raw_data)
+		return json.dumps(data, default=repr)
+
+class PrefilterPatterns:
+	def __init__(self, convert):
+		self.d_key = convert('"d":')
+		self.message_create = convert('"t":"MESSAGE_CREATE"')
+		self.seq = re.compile(convert(r'"s":(\d+)'))
+		self.command = re.compile(convert(r'"content":"(?:!|oh no\.")'))
+
+prefilter_str = PrefilterPatterns(str)
+prefilter_bytes = PrefilterPatterns(lambda s: s.encode('ascii'))
+
+codecs = {codec.name: codec for codec in [JsonCodec, EtfCodec]}
+
+def get(name):
+	return codecs[name]
+
+VERSION = 131
+NEW_FLOAT_EXT = 70
+SMALL_INTEGER_EXT = 97
+INTEGER_EXT = 98
+FLOAT_EXT = 99
+ATOM_EXT = 100
+SMALL_TUPLE_EXT = 104
+LARGE_TUPLE_EXT = 105
+NIL_EXT = 106
+STRING_EXT = 107
+LIST_EXT = 108
+BINARY_EXT = 109
+SMALL_BIG_EXT = 110
+LARGE_BIG_EXT = 111
+MAP_EXT = 116
+SMALL_ATOM_EXT = 115
+ATOM_UTF8_EXT = 118
+SMALL_ATOM_UTF8_EXT = 119
+COMPRESSED = 80
+
+atoms = {'nil': None, 'true': True, 'false': False}
+
+def _decode_term(buf, i):
+	tag = buf[i]
+	i += 1
+	if tag == BINARY_EXT:
+		length, = struct.unpack_from('>I', buf, i)
+		i += 4
+		return buf[i:i+length].decode('utf-8'), i + length
+	elif tag == SMALL_INTEGER_EXT:
+		return buf[i], i + 1
+	elif tag == INTEGER_EXT:
+		return struct.unpack_from('>i', buf, i)[0], i + 4
+	elif tag == MAP_EXT:
+		arity, = struct.unpack_from('>I', buf, i)
+		i += 4
+		d = {}
+		for _ in range(arity):
+			key, i = _decode_term(buf, i)
+			d[key], i = _decode_term(buf, i)
+		return d, i
+	elif tag in (SMALL_ATOM_UTF8_EXT, SMALL_ATOM_EXT):
+		length = buf[i]
+		name = buf[i+1:i+1+length].decode('utf-8')
+		return atoms.get(name, name), i + 1 + length
+	elif tag in (ATOM_UTF8_EXT, ATOM_EXT):
+		length, = struct.unpack_from('>H', buf, i)
+		name = buf[i+2:i+2+length].decode('utf-8')
+		return atoms.get(name, name), i + 2 + length
+	elif tag == LIST_EXT:
+		length, = struct.unpack_from('>I', buf, i)
+		i += 4
+		items = []
+		for _ in range(length):
+			item, i = _decode_term(buf, i)
+			items.append(item)
+		_, i = _decode_term(buf, i) # tail, NIL_EXT for proper lists
+		return items, i
+	elif tag == NIL_EXT:
+		return [], i
+	elif tag in (SMALL_BIG_EXT, LARGE_BIG_EXT):
+		if tag == SMALL_BIG_EXT:
+			length = buf[i]
+			i += 1
+		else:
+			length, = struct.unpack_from('>I', buf, i)
+			i += 4
+		sign = buf[i]
+		n = int.from_bytes(buf[i+1:i+1+length], 'little')
+		# only snowflakes are this big. the JSON gateway sends them as strings and so does the rest
+		# of the bot, so keep it that way
+		return str(-n if sign else n), i + 1 + length
+	elif tag == NEW_FLOAT_EXT:
+		return struct.unpack_from('>d', buf, i)[0], i + 8
+	elif tag == FLOAT_EXT:
+		return float(buf[i:i+31].rstrip(b'\x00')), i + 31
+	elif tag == STRING_EXT:
+		length, = struct.unpack_from('>H', buf, i)
+		return buf[i+2:i+2+length].decode('latin-1'), i + 2 + length
+	elif tag in (SMALL_TUPLE_EXT, LARGE_TUPLE_EXT):
+		if tag == SMALL_TUPLE_EXT:
+			arity = buf[i]
+			i += 1
+		else:
+			arity, = struct.unpack_from('>I', buf, i)
+			i += 4
+		items = []
+		for _ in range(arity):
+			item, i = _decode_term(buf, i)
+			items.append(item)
+		return tuple(items), i
+	elif tag == COMPRESSED:
+		size, = struct.unpack_from('>I', buf, i)
+		inflated = zlib.decompress(buf[i+4:])
+		if len(inflated) != size:
+			raise ValueError('compressed term is %d bytes, expected %d' % (len(inflated), size))
+		value, _ = _decode_term(inflated, 0)
+		return value, len(buf)
+	raise ValueError('unsupported ETF tag %d at %d' % (tag, i - 1))
+
+def _encode_term(value, out):
+	if value is None:
+		_encode_atom('nil', out)
+	elif value is True:
+		_encode_atom('true', out)
+	elif value is False:
+		_encode_atom('false', out)
+	elif isinstance(value, int):
+		if 0 <= value < 256:
+			out.append(SMALL_INTEGER_EXT)
+			out.append(value)
+		elif -2**31 <= value < 2**31:
+			out.append(INTEGER_EXT)
+			out += struct.pack('>i', value)
+		else:
+			magnitude = abs(value)
+			digits = magnitude.to_bytes((magnitude.bit_length() + 7) // 8, 'little')
+			out.append(SMALL_BIG_EXT)
+			out.append(len(digits))
+			out.append(1 if value < 0 else 0)
+			out += digits
+	elif isinstance(value, float):
+		out.append(NEW_FLOAT_EXT)
+		out += struct.pack('>d', value)
+	elif isinstance(value, str):
+		encoded = value.encode('utf-8')
+		out.append(BINARY_EXT)
+		out += struct.pack('>I', len(encoded))
+		out += encoded
+	elif isinstance(value, dict):
+		out.append(MAP_EXT)
+		out += struct.pack('>I', len(value))
+		for k, v in value.items():
+			_encode_term(k, out)
+			_encode_term(v, out)
+	elif isinstance(value, (list, tuple)):
+		if not value:
+			out.append(NIL_EXT)
+			return
+		out.append(LIST_EXT)
+		out += struct.pack('>I', len(value))
+		for item in value:
+			_encode_term(item, out)
+		out.append(NIL_EXT)
+	else:
+		raise TypeError("can't encode %r as ETF" % (value,))
+
+def _encode_atom(name, out):
+	encoded = name.encode('utf-8')
+	out.append(SMALL_ATOM_UTF8_EXT)
+	out.append(len(encoded))
+	out += encoded
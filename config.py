@@ -1,30 +1,218 @@
+import contextlib
+import copy
+import datetime
+import fcntl
+import json
+import os
+import threading
+
 import yaml
 
 import log
 
+# libyaml's loader and dumper, when PyYAML was built with it, are several times faster
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 class YamlAttrs:
-	def __init__(self, filename, defaults=None):
+	def __init__(self, filename):
 		self.filename = filename
+		with open(filename, 'r') as f:
+			doc = yaml.load(f, Loader=Loader)
+		for k, v in doc.items():
+			setattr(self, k, v)
+
+	def __str__(self):
+		return '%s %s' % (self.__class__, self.__dict__)
+
+class State:
+	# state.yaml is a snapshot and every change since is a JSON line in state.yaml.journal, so a
+	# change costs one small append instead of rewriting the whole file. snapshots go to a temporary
+	# file that's renamed over state.yaml, so a crash leaves either the old snapshot or the new one
+	#
+	# shard processes share these files. each holds an flock on state.yaml.lock while it touches
+	# them and first catches up on whatever the others have journaled, so every process sees every
+	# change and a snapshot is always written from the merged state
+	compact_after = 1000 # journal lines
+
+	def __init__(self, filename, defaults):
+		self.__dict__.update({
+			'filename': filename,
+			'journal_filename': filename + '.journal',
+			'lock_filename': filename + '.lock',
+			'defaults': defaults,
+			'data': None,
+			'lock': threading.RLock(), # changes come from both the event loop and command threads
+			'pid': None, # the process the files below were opened in; a forked child reopens them
+			'lock_fd': None,
+			'journal_fd': None,
+			'snapshot': None, # (inode, mtime, size) of the state.yaml data was loaded from
+			'offset': 0, # how much of the journal has been applied to data
+			'journaled': 0, # entries in the journal
+			'partial': False, # the journal ends in a cut off entry
+		})
+		with self._locked(fcntl.LOCK_EX):
+			if self.snapshot is None:
+				log.write('creating ' + filename)
+			if self.journaled or self.snapshot is None:
+				self._compact()
+
+	def __getattr__(self, name):
+		with self._locked(fcntl.LOCK_SH):
+			try:
+				return self.data[name]
+			except KeyError:
+				raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+		self.put((name,), value)
+
+	def put(self, path, value):
+		# path is a tuple of keys, like ('timers', channel_id, name). missing dicts along it are created
+		with self._locked(fcntl.LOCK_EX):
+			self._apply('put', path, value)
+			self._append('put', path, value)
+
+	def delete(self, path):
+		# dicts along the path that end up empty are removed too. returns False, and does nothing, if
+		# it's already gone (perhaps deleted by another shard)
+		with self._locked(fcntl.LOCK_EX):
+			if not self._apply('delete', path, None):
+				return False
+			self._append('delete', path, None)
+			return True
 
+	def save(self):
+		# writes a snapshot and empties the journal
+		with self._locked(fcntl.LOCK_EX):
+			self._compact()
+
+	@contextlib.contextmanager
+	def _locked(self, operation):
+		with self.lock:
+			if self.pid != os.getpid():
+				self._open()
+			fcntl.flock(self.lock_fd, operation)
+			try:
+				self._refresh()
+				yield
+			finally:
+				fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+	def _open(self):
+		# flocks belong to the open file, which a forked child shares with its parent, so each
+		# process needs its own
+		for fd in (self.lock_fd, self.journal_fd):
+			if fd is not None:
+				os.close(fd)
+		self.__dict__.update({
+			'pid': os.getpid(),
+			'lock_fd': os.open(self.lock_filename, os.O_RDWR | os.O_CREAT, 0o644),
+			'journal_fd': os.open(self.journal_filename, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644),
+		})
+
+	def _refresh(self):
+		# with the file lock held: reload if another process wrote a snapshot, then apply any new
+		# journal entries
 		try:
-			with open(filename, 'r') as f:
-				doc = yaml.load(f)
+			st = os.stat(self.filename)
+			snapshot = (st.st_ino, st.st_mtime_ns, st.st_size)
 		except FileNotFoundError:
-			doc = defaults
-			log.write('creating ' + self.filename)
-			self.save()
+			snapshot = None
+		size = os.fstat(self.journal_fd).st_size
+		if self.data is None or snapshot != self.snapshot or size < self.offset:
+			data = copy.deepcopy(self.defaults)
+			if snapshot is not None:
+				with open(self.filename, 'r') as f:
+					data.update(yaml.load(f, Loader=Loader) or {})
+			self.__dict__.update({'data': data, 'snapshot': snapshot, 'offset': 0, 'journaled': 0})
+		if size == self.offset:
+			return
 
-		for k, v in doc.items():
-			setattr(self, k, v)
+		chunk = os.pread(self.journal_fd, size - self.offset, self.offset)
+		lines = chunk.split(b'\n')
+		# a last entry without its newline was cut off by a crash; it's skipped once more is appended
+		complete = lines[:-1]
+		for line in complete:
+			try:
+				op, path, value = json.loads(line.decode('utf-8'), object_hook=_decode)
+			except ValueError:
+				log.write('%s: ignoring truncated entry after %d' % (self.journal_filename, self.journaled))
+				continue
+			self._apply(op, path, value)
+			self.__dict__['journaled'] += 1
+		self.__dict__['offset'] += len(chunk) - len(lines[-1])
+		self.__dict__['partial'] = bool(lines[-1])
 
-	def save(self):
-		with open(self.filename, 'w') as f:
-			data = dict(self.__dict__)
-			del data['filename']
-			yaml.dump(data, f)
+	def _apply(self, op, path, value):
+		# returns whether anything changed
+		parents = [self.data]
+		for key in path[:-1]:
+			if op == 'put':
+				parents.append(parents[-1].setdefault(key, {}))
+			elif key in parents[-1]:
+				parents.append(parents[-1][key])
+			else:
+				return False
+		if op == 'put':
+			parents[-1][path[-1]] = value
+			return True
+		if path[-1] not in parents[-1]:
+			return False
+		del parents[-1][path[-1]]
+		for i in range(len(parents) - 1, 1, -1):
+			if parents[i]:
+				break
+			del parents[i-1][path[i-1]]
+		return True
+
+	def _append(self, op, path, value):
+		# with the file lock held exclusively
+		entry = json.dumps([op, list(path), value], default=_encode).encode('utf-8') + b'\n'
+		if self.partial:
+			entry = b'\n' + entry
+		os.write(self.journal_fd, entry)
+		self.__dict__.update({
+			'offset': os.fstat(self.journal_fd).st_size,
+			'journaled': self.journaled + 1,
+			'partial': False,
+		})
+		if self.journaled >= self.compact_after:
+			self._compact()
+
+	def _compact(self):
+		# with the file lock held exclusively, so data has every process's changes
+		tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+		with open(tmp_filename, 'w') as f:
+			yaml.dump(self.data, f, Dumper=Dumper, default_flow_style=False)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_filename, self.filename)
+		os.ftruncate(self.journal_fd, 0)
+		st = os.stat(self.filename)
+		self.__dict__.update({
+			'snapshot': (st.st_ino, st.st_mtime_ns, st.st_size),
+			'offset': 0,
+			'journaled': 0,
+			'partial': False,
+		})
 
 	def __str__(self):
-		return '%s %s' % (self.__class__, self.__dict__)
+		return '%s %s' % (self.__class__, self.data)
+
+def _encode(value):
+	if isinstance(value, datetime.datetime):
+		return {'__datetime__': value.isoformat()}
+	raise TypeError("can't journal %r" % (value,))
+
+def _decode(d):
+	if '__datetime__' in d:
+		value = d['__datetime__']
+		# isoformat() leaves out the microseconds when there aren't any
+		return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+	return d
+
+state_defaults = {'gateway_url': None, 'timers': {}, 'reminders': {}, 'reddit_access_token': None}
 
 bot = YamlAttrs('config.yaml')
-state = YamlAttrs('state.yaml', defaults={'gateway_url': None, 'timers': {}, 'reddit_access_token': None})
+state = State('state.yaml', state_defaults)
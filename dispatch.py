@@ -0,0 +1,100 @@
+import asyncio
+from collections import defaultdict, deque
+import concurrent.futures
+import json
+import time
+
+import config
+import log
+import metrics
+
+class Dispatcher:
+	def __init__(self, bot):
+		self.bot = bot
+		settings = config.bot.dispatch
+		self.queue_size = settings['queue_size']
+		self.timeout = settings['timeout']
+		self.timeouts = settings.get('timeouts') or {} # trigger -> seconds
+		self.limits = settings.get('concurrency') or {} # trigger or module name -> max running
+		# commands that time out keep their thread until they return, so leave some headroom
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings['workers'] * 2)
+		self.workers = []
+		self.ready = None
+		self.pending = 0 # queued, deferred by a concurrency cap, or running
+		self.running = defaultdict(int) # limit key -> running jobs
+		self.deferred = defaultdict(deque) # limit key -> jobs waiting on a concurrency cap
+		metrics.Gauge('sbot_command_queue_depth', 'commands queued, deferred or running',
+				func=lambda: self.pending)
+		metrics.Gauge('sbot_command_deferred', 'commands waiting on a per-command concurrency cap',
+				func=lambda: sum(len(jobs) for jobs in self.deferred.values()))
+
+	def start(self):
+		if self.workers:
+			return
+		self.ready = asyncio.Queue()
+		for _ in range(config.bot.dispatch['workers']):
+			self.workers.append(self.bot.spawn(self._worker()))
+
+	def submit(self, trigger, handler, cmd, d):
+		if self.pending >= self.queue_size:
+			metrics.commands_shed.inc()
+			log.write('dispatch: queue full (%d), dropping !%s' % (self.pending, trigger))
+			self.bot.spawn(self.bot.create_message(cmd.channel_id,
+					'%s: too busy right now, try again in a bit' % cmd.sender['username']))
+			return
+		job = Job(trigger, handler, cmd, d)
+		self.pending += 1
+		key = self._limit_key(trigger, handler)
+		if key is not None and self.running[key] >= self.limits[key]:
+			self.deferred[key].append(job)
+		else:
+			self.running[key] += 1
+			self.ready.put_nowait(job)
+
+	def _limit_key(self, trigger, handler):
+		if trigger in self.limits:
+			return trigger
+		if handler.__module__ in self.limits:
+			return handler.__module__
+		return None
+
+	async def _worker(self):
+		while True:
+			job = await self.ready.get()
+			job.started = time.monotonic()
+			metrics.command_wait.observe(job.started - job.enqueued)
+
+			future = self.bot.loop.run_in_executor(self.executor, job.handler, job.cmd)
+			future.add_done_callback(lambda _, job=job: self._finished(job))
+			timeout = self.timeouts.get(job.trigger, self.timeout)
+			try:
+				await asyncio.wait_for(asyncio.shield(future), timeout)
+			except asyncio.TimeoutError:
+				metrics.commands_timed_out.inc(job.trigger)
+				# the thread can't be interrupted; drop whatever it replies with from now on
+				job.cmd.cancelled = True
+				log.write('dispatch: !%s timed out after %ds' % (job.trigger, timeout))
+				# spawned, so a failed post can't take this worker down with it
+				self.bot.spawn(self.bot.create_message(job.cmd.channel_id,
+						'%s: !%s timed out' % (job.cmd.sender['username'], job.trigger)))
+			except:
+				self.bot.report_error(json.dumps(job.d))
+
+	def _finished(self, job):
+		metrics.command_seconds.observe(time.monotonic() - job.started, job.trigger)
+		self.pending -= 1
+		key = self._limit_key(job.trigger, job.handler)
+		deferred = self.deferred.get(key)
+		if deferred:
+			self.ready.put_nowait(deferred.popleft())
+		else:
+			self.running[key] -= 1
+
+class Job:
+	def __init__(self, trigger, handler, cmd, d):
+		self.trigger = trigger
+		self.handler = handler
+		self.cmd = cmd
+		self.d = d
+		self.enqueued = time.monotonic()
+		self.started = None
@@ -0,0 +1,79 @@
+import asyncio
+from os import path
+import traceback
+import zlib
+
+import config
+import log
+
+root = path.dirname(path.abspath(__file__))
+
+# collapses repeated handler/command exceptions so one broken command can't flood err_channel.
+# the first occurrence of a traceback is posted in full; repeats are counted and summarized once
+# per interval
+
+class ErrorAggregator:
+	def __init__(self, bot):
+		self.bot = bot
+		self.interval = config.bot.err_interval
+		self.seen = {} # fingerprint -> [where, repeats this interval]
+
+	def report(self, raw_data, exc_type, exc, tb):
+		fingerprint, where = _fingerprint(exc_type, tb)
+		entry = self.seen.get(fingerprint)
+		if entry is not None:
+			entry[1] += 1
+			log.write('%s (repeat)' % where, fingerprint=fingerprint)
+			return
+		self.seen[fingerprint] = [where, 0]
+
+		formatted = ''.join(traceback.format_exception(exc_type, exc, tb))
+		log.write(raw_data)
+		log.write(formatted, fingerprint=fingerprint)
+		if config.bot.err_channel:
+			# messages can be up to 2000 characters
+			self.bot.spawn(self.bot.create_message(config.bot.err_channel,
+					'```\n%s\n```\n```\n%s\n```' % (raw_data[:800], formatted[:1000])))
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			self.flush()
+
+	def flush(self):
+		lines = []
+		for fingerprint, (where, repeats) in list(self.seen.items()):
+			if repeats == 0:
+				# quiet for a whole interval; the next one gets posted in full again
+				del self.seen[fingerprint]
+			else:
+				lines.append('%s ×%d in last %s' % (where, repeats, _duration(self.interval)))
+				self.seen[fingerprint][1] = 0
+		if not lines:
+			return
+		summary = '\n'.join(lines)
+		log.write(summary)
+		if config.bot.err_channel:
+			self.bot.spawn(self.bot.create_message(config.bot.err_channel, summary[:2000]))
+
+def _fingerprint(exc_type, tb):
+	# the exception type and the functions it went through, without line numbers or messages, so
+	# the same bug hit with different data (or after an unrelated edit) still matches
+	frames = []
+	where = None
+	for frame, _ in traceback.walk_tb(tb):
+		code = frame.f_code
+		frames.append('%s:%s' % (path.basename(code.co_filename), code.co_name))
+		if path.dirname(path.abspath(code.co_filename)) == root:
+			where = '%s.%s' % (frame.f_globals.get('__name__'), code.co_name)
+	fingerprint = '%08x' % zlib.crc32(' '.join([exc_type.__name__] + frames).encode('utf-8'))
+	if where is None:
+		where = frames[-1] if frames else '?'
+	return fingerprint, '%s in %s' % (exc_type.__name__, where)
+
+def _duration(seconds):
+	if seconds % 3600 == 0:
+		return '%dh' % (seconds // 3600)
+	if seconds % 60 == 0:
+		return '%dm' % (seconds // 60)
+	return '%ds' % seconds
@@ -1,88 +1,55 @@
+import collections
+import concurrent.futures
 import datetime
-from math import sqrt
-import operator
-import sqlite3
+import threading
 import time
 
 import requests
 
 import config
+from eve_items import ItemIndex
+import eve_map
+import eve_prices
+import httpclient
+import sde
 
-rs = requests.Session()
-rs.headers.update({'User-Agent': 'sbot'})
 if config.bot.eve_db is not None:
-	db = sqlite3.connect(config.bot.eve_db)
+	sde_file = sde.load(config.bot.eve_db, config.bot.eve_sde)
+	items = ItemIndex(sde_file)
+	starmap = eve_map.Map(sde_file)
 
-esi_price_cache = {'last_update': 0, 'items': {}}
+esi_prices = eve_prices.snapshots
+stale_prices = 6 * 60 * 60 # seconds
 
 
 def price_check(cmd):
-	def __item_info(query):
-		curs = db.execute('''
-			SELECT "typeID", "typeName" FROM "invTypes"
-			WHERE LOWER("typeName") LIKE ? AND "marketGroupID" IS NOT NULL
-			''', (query.lower(),))
-		results = curs.fetchmany(3)
+	def item_info(item_name):
+		result = items.exact_match(item_name)
+		if result:
+			return result
+
+		results = items.search(item_name)
 		if len(results) == 1:
 			return results[0]
 		if len(results) == 2 and \
-                        results[0][1].endswith('Blueprint') ^ results[1][1].endswith('Blueprint'):
+				results[0][1].endswith('Blueprint') ^ results[1][1].endswith('Blueprint'):
 			# an item and its blueprint; show the item
 			if results[0][1].endswith('Blueprint'):
 				return results[1]
 			else:
 				return results[0]
-		if len(results) >= 2:
-			return results
-		return None
-
-	def item_info(item_name):
-		# exact match
-		curs = db.execute(
-			'SELECT "typeID", "typeName" FROM "invTypes" WHERE LOWER("typeName") LIKE ?',
-			(item_name.lower(),))
-		result = curs.fetchone()
-		if result:
-			return result
-
-		# start of string match
-		results = __item_info(item_name + '%')
-		if isinstance(results, tuple):
-			return results
-		if results:
-			names = map(lambda r: r[1], results)
-			cmd.reply('Found items: ' + ', '.join(names))
-			return None
-
-		# substring match
-		results = __item_info('%' + item_name + '%')
-		if isinstance(results, tuple):
-			return results
 		if results:
 			names = map(lambda r: r[1], results)
 			cmd.reply('Found items: ' + ', '.join(names))
 			return None
-		cmd.reply('Item not found')
-		return None
 
-	def get_esi_price(typeid):
-		now = time.time()
-		if esi_price_cache['last_update'] < now - 60 * 60 * 2:
-			res = rs.get(
-				'https://esi.evetech.net/latest/markets/prices/?datasource=tranquility')
-			if res.status_code == 200:
-				esi_price_cache['items'].clear()
-				for item in res.json():
-					esi_price_cache['items'][item['type_id']] = item
-		prices = esi_price_cache['items'][typeid]
-		if prices and 'average_price' in prices:
-			if prices['average_price'] < 1000.0:
-				return 'avg {average_price:g} adj {adjusted_price:g}'.format(**prices)
-			for k, v in prices.items():
-				prices[k] = int(v)
-			return 'avg {average_price:,d} adj {adjusted_price:,d}'.format(**prices)
+		suggestions = items.fuzzy(item_name)
+		if suggestions:
+			names = map(lambda r: r[1], suggestions)
+			cmd.reply('Item not found. Did you mean: ' + ', '.join(names))
 		else:
-			return 'n/a'
+			cmd.reply('Item not found')
+		return None
 
 	if not cmd.args:
 		return
@@ -90,85 +57,75 @@ def price_check(cmd):
 	if not result:
 		return
 	typeid, item_name = result
-	esi = get_esi_price(typeid)
+	esi = eve_prices.format_price(esi_prices.get(typeid))
+	age = esi_prices.age()
+	if age is not None and age > stale_prices:
+		esi += ' (as of %d hours ago)' % (age // 3600)
 	cmd.reply('%s: %s' % (item_name, esi))
 
 
+jumps_usage = 'usage: `!jumps [from] [to] (shortest|safe|insecure) (avoid [system] ...)`'
 def jumps(cmd):
 	split = cmd.args.split()
+	avoid_names = []
+	if 'avoid' in split:
+		avoid_at = split.index('avoid')
+		split, avoid_names = split[:avoid_at], split[avoid_at+1:]
 	if not 2 <= len(split) <= 3:
-		cmd.reply('usage: `!jumps [from] [to] (safe|shortest)`')
+		cmd.reply(jumps_usage)
 		return
-	results = []
-	for i in range(2):
-		curs = db.execute('''
-			SELECT "solarSystemID" FROM "mapSolarSystems"
-			WHERE "solarSystemName" LIKE ? LIMIT 3
-			''', (split[i],))
-		matches = list(map(operator.itemgetter(0), curs.fetchall()))
+	flag = 'shortest'
+	if len(split) == 3:
+		if split[2] in ['safe', 'secure']:
+			flag = 'secure'
+		elif split[2] in ['unsafe', 'insecure']:
+			flag = 'insecure'
+
+	names = split[:2] + avoid_names
+	systems = []
+	for name, matches in zip(names, starmap.resolve(names)):
 		if len(matches) == 0:
-			cmd.reply('no systems found for {}'.format(split[i]))
+			cmd.reply('no systems found for {}'.format(name))
 			return
-		elif len(matches) == 1:
-			results.append(matches[0])
-		else:
-			raise Exception('more than 1 system found', split[i])
-
-	if len(split) == 3 and split[2] in ['safe', 'secure']:
-		flag = 'secure'
-	else:
-		flag = 'shortest'
+		elif len(matches) > 1:
+			cmd.reply('{} could be {}'.format(name, ', '.join(starmap.names[i] for i in matches[:5])))
+			return
+		systems.append(matches[0])
 
-	r = rs.get('https://esi.evetech.net/latest/route/{}/{}/?datasource=tranquility&flag={}'.format(
-			results[0], results[1], flag))
-	try:
-		data = r.json()
-	except ValueError:
-		cmd.reply('error getting jumps')
+	route = starmap.route(systems[0], systems[1], flag, frozenset(systems[2:]))
+	if route is None:
+		cmd.reply('no route from {} to {}'.format(starmap.names[systems[0]], starmap.names[systems[1]]))
 		return
 	jumps_split = []
-	if 'error' in data:
-		cmd.reply("Error: {}".format(data['error']))
-		return
-	for j in data:
-		curs.execute('''SELECT "solarSystemName", "security"
-						FROM "mapSolarSystems"
-						WHERE "solarSystemID" = ?''', (j,))
-		result = list(map(str, curs.fetchone()))
-		result[1] = result[1][:3]
-		jumps_split.append(" ".join(result))
+	for i in route:
+		jumps_split.append('{} {}'.format(starmap.names[i], str(starmap.security[i])[:3]))
 	cmd.reply('{} jumps:\n'.format(len(jumps_split)-1) + " -> ".join(jumps_split))
 
 
+ship_ranges = [
+	('other:\t ', 3.5),
+	('blops:\t ', 4.0),
+	('JF:\t\t', 5.0),
+	('super:\t ', 3.0),
+]
+
 def lightyears(cmd):
-	split = [n + '%' for n in cmd.args.lower().split()]
+	split = cmd.args.split()
 	if len(split) != 2:
 		cmd.reply('usage: !ly [from] [to]')
 		return
 
-	curs = db.execute('''
-		SELECT "solarSystemName", x, y, z FROM "mapSolarSystems"
-		WHERE LOWER("solarSystemName") LIKE ? OR LOWER("solarSystemName") LIKE ?
-		LIMIT 6
-		''', (split[0], split[1]))
-	result = curs.fetchall()
-	if len(result) < 2:
-		cmd.reply('error: one or both systems not found')
-		return
-	elif len(result) > 2:
-		cmd.reply('error: found too many systems: ' + ' '.join(map(operator.itemgetter(0), result)))
-		return
+	systems = []
+	for name, matches in zip(split, starmap.resolve(split)):
+		if len(matches) == 0:
+			cmd.reply('error: no systems found for %s' % name)
+			return
+		elif len(matches) > 1:
+			cmd.reply('error: found too many systems: ' + ' '.join(starmap.names[i] for i in matches[:6]))
+			return
+		systems.append(matches[0])
 
-	dist = 0
-	for d1, d2 in zip(result[0][1:], result[1][1:]):
-		dist += (d1 - d2)**2
-	dist = sqrt(dist) / 9.4605284e15  # meters to lightyears
-	ship_ranges = [
-		('other:\t ', 3.5),
-		('blops:\t ', 4.0),
-		('JF:\t\t', 5.0),
-		('super:\t ', 3.0),
-	]
+	dist = starmap.distance(systems[0], systems[1])
 	jdc = []
 	for ship, jump_range in ship_ranges:
 		for level in range(0, 6):
@@ -178,15 +135,98 @@ def lightyears(cmd):
 		else:
 			jdc.append(ship + 'N/A')
 	cmd.reply('```%s ⟷ %s: %.3f ly\n%s```' %
-		(result[0][0], result[1][0], dist, '\n'.join(jdc)))
+		(starmap.names[systems[0]], starmap.names[systems[1]], dist, '\n'.join(jdc)))
 
+range_usage = 'usage: `!range [system] (other|blops|jf|super) (jdc level, default 5) (lowsec|nullsec)`'
+def range_check(cmd):
+	split = cmd.args.split()
+	if not 1 <= len(split) <= 4:
+		cmd.reply(range_usage)
+		return
+	ships = {ship.split(':')[0].lower(): jump_range for ship, jump_range in ship_ranges}
+	ship, level, space = 'other', 5, None
+	for arg in split[1:]:
+		if arg.lower() in ships:
+			ship = arg.lower()
+		elif arg in ('lowsec', 'nullsec'):
+			space = arg
+		elif arg.isdigit() and int(arg) <= 5:
+			level = int(arg)
+		else:
+			cmd.reply(range_usage)
+			return
+
+	matches = starmap.resolve(split[:1])[0]
+	if len(matches) != 1:
+		cmd.reply('error: found %d systems for %s' % (len(matches), split[0]))
+		return
+	origin = matches[0]
+	radius = ships[ship] * (1 + level * 0.2)
+	systems, distances = starmap.within(origin, radius)
+	# jump drives can't go to highsec
+	security = starmap.security_array[systems]
+	if space == 'lowsec':
+		keep = (security >= eve_map.lowsec) & (security < eve_map.highsec)
+	elif space == 'nullsec':
+		keep = security < eve_map.lowsec
+	else:
+		keep = security < eve_map.highsec
+	systems, distances = systems[keep], distances[keep]
+
+	header = '%d systems within %.2f ly of %s (%s, JDC %d):' % (
+			len(systems), radius, starmap.names[origin], ship, level)
+	lines = []
+	length = len(header) + 10
+	for i, dist in zip(systems.tolist(), distances.tolist()):
+		line = '%s %.1f %.2f ly' % (starmap.names[i], starmap.security[i], dist)
+		length += len(line) + 1
+		if length > 1900:
+			lines.append('and %d more' % (len(systems) - len(lines)))
+			break
+		lines.append(line)
+	cmd.reply('```%s\n%s```' % (header, '\n'.join(lines)))
+
+
+class TTLCache:
+	# the most recently used entries, each kept for ttl seconds. thread-safe; two threads missing
+	# the same key at once both fetch it
+	def __init__(self, ttl, maxsize):
+		self.ttl = ttl
+		self.maxsize = maxsize
+		self.entries = collections.OrderedDict() # key -> (expires, value)
+		self.lock = threading.Lock()
+
+	def get(self, key, fetch):
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and entry[0] > now:
+				self.entries.move_to_end(key)
+				return entry[1]
+		value = fetch()
+		with self.lock:
+			self.entries[key] = (now + self.ttl, value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+		return value
+
+# who's lookups run concurrently on this pool; corp and alliance records rarely change
+who_pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+who_caches = {
+	'ids': TTLCache(60 * 60, 1024),
+	'characters': TTLCache(10 * 60, 1024),
+	'corporations': TTLCache(6 * 60 * 60, 1024),
+	'alliances': TTLCache(6 * 60 * 60, 512),
+	'zkill_stats': TTLCache(5 * 60, 2048),
+	'last_active': TTLCache(5 * 60, 1024),
+}
 
 def who(cmd):
 	if len(cmd.args) == 0:
 		cmd.reply('usage: !who [name]')
 		return
 
-	char_info, corp_info, alliance_info = None, None, None
 	entity_type_map = {
 		0: 'characterID',
 		1: 'corporationID',
@@ -194,48 +234,49 @@ def who(cmd):
 	}
 	dt_format = '%Y-%m-%dT%H:%M:%SZ'
 
-	def get_char_info(char_id):
-		r = rs.get('https://esi.evetech.net/latest/characters/{}/'.format(char_id), params={'datasource': 'tranquility'})
-		char_info = r.json()
-		killed, lost = get_zkill_stats(char_id, 0)
-		last_active = get_last_active(char_id, 0)
-		return char_info, killed, lost, last_active
-
-	def get_corp_info(corp_id):
-		r = rs.get('https://esi.evetech.net/latest/corporations/{}/'.format(corp_id), params={'datasource': 'tranquility'})
-		corp_info = r.json()
-		active_members = get_group_actives(corp_id, 1)
-		return corp_info, active_members
-
-	def get_alliance_info(alliance_id):
-		r = rs.get('https://esi.evetech.net/latest/alliances/{}/'.format(alliance_id), params={'datasource': 'tranquility'})
-		alliance_info = r.json()
-		active_members = get_group_actives(alliance_id, 2)
-		return alliance_info, active_members
+	def get_ids(name):
+		def fetch():
+			r = httpclient.post('https://esi.evetech.net/latest/universe/ids/',
+					params={'datasource': 'tranquility', 'language': 'en-us'},
+					json=[name])
+			r.raise_for_status()
+			return r.json()
+		return who_caches['ids'].get(name.casefold(), fetch)
+
+	def get_esi(kind, entity_id):
+		def fetch():
+			r = httpclient.get('https://esi.evetech.net/latest/{}/{}/'.format(kind, entity_id),
+					params={'datasource': 'tranquility'})
+			r.raise_for_status()
+			return r.json()
+		return who_caches[kind].get(entity_id, fetch)
 
 	def get_zkill_stats(entity_id, entity_type):
-		r = rs.get('https://zkillboard.com/api/stats/{entity_type}/{entity_id}/'.format(
-				entity_id=entity_id, entity_type=entity_type_map[entity_type]))
-		stats = r.json()
-		killed = stats.get('shipsDestroyed', 0)
-		lost = stats.get('shipsLost', 0)
-		return killed, lost
-
-	def get_group_actives(entity_id, entity_type):
-		r = rs.get('https://zkillboard.com/api/stats/{entity_type}/{entity_id}/'.format(
-				entity_type=entity_type_map[entity_type], entity_id=entity_id))
-		data = r.json()
+		# one stats document has both the kill counts and the active pilots
+		def fetch():
+			r = httpclient.get('https://zkillboard.com/api/stats/{entity_type}/{entity_id}/'.format(
+					entity_id=entity_id, entity_type=entity_type_map[entity_type]))
+			return r.json() or {}
+		return who_caches['zkill_stats'].get((entity_type, entity_id), fetch)
+
+	def get_kills_losses(stats):
+		return stats.get('shipsDestroyed', 0), stats.get('shipsLost', 0)
+
+	def get_group_actives(stats):
 		try:
-			return data['activepvp']['characters']['count']
+			return stats['activepvp']['characters']['count']
 		except KeyError:
 			return 0
 
 	def get_last_active(entity_id, entity_type):
-		r = rs.get('https://zkillboard.com/api/{entity_type}/{entity_id}/'.format(
-				entity_id=entity_id, entity_type=entity_type_map[entity_type]))
-		kills = r.json()
-		if len(kills) > 0:
-			return kills[0]
+		def fetch():
+			r = httpclient.get('https://zkillboard.com/api/{entity_type}/{entity_id}/'.format(
+					entity_id=entity_id, entity_type=entity_type_map[entity_type]))
+			kills = r.json()
+			if len(kills) > 0:
+				return kills[0]
+			return None
+		return who_caches['last_active'].get((entity_type, entity_id), fetch)
 
 	def get_humanized_timedelta(timestamp):
 		last = datetime.datetime.strptime(timestamp, dt_format)
@@ -256,55 +297,78 @@ def who(cmd):
 				return k, '{:1.0f}'.format(v)
 
 	try:
-		r = rs.post('https://esi.evetech.net/latest/universe/ids/',
-				params={'datasource': 'tranquility', 'language': 'en-us'},
-				json=[cmd.args])
-		r.raise_for_status()
-	except requests.exceptions.HTTPError:
+		initial_id = get_ids(cmd.args)
+	except requests.exceptions.RequestException:
 		cmd.reply('{}: esi error'.format(cmd.sender['username']))
 		return
-
-	initial_id = r.json()
 	if len(initial_id) == 0:
 		cmd.reply("%s: couldn't find your sleazebag" % cmd.sender['username'])
 		return
 
-	corp_id = alliance_id = None
-	output = ''
+	# everything that only needs ids we already have is started at once: the character's record,
+	# stats and last kill, then the corp and alliance records and stats as soon as their ids are known
+	futures = {}
+	def start(name, func, *args):
+		if name not in futures:
+			futures[name] = who_pool.submit(func, *args)
+
+	char_id = corp_id = alliance_id = None
 	if 'characters' in initial_id:
-		try:
-			char_info, killed, lost, last_active = get_char_info(initial_id['characters'][0]['id'])
-		except requests.exceptions.HTTPError:
-			cmd.reply("%s: couldn't find your sleazebag" % cmd.sender['username'])
+		char_id = initial_id['characters'][0]['id']
+		start('char', get_esi, 'characters', char_id)
+		start('char_stats', get_zkill_stats, char_id, 0)
+		start('last_active', get_last_active, char_id, 0)
+	elif 'corporations' in initial_id:
+		corp_id = initial_id['corporations'][0]['id']
+	if 'alliances' in initial_id and char_id is None and corp_id is None:
+		alliance_id = initial_id['alliances'][0]['id']
 
-		if last_active is not None:
-			span, value = get_humanized_timedelta(last_active['killmail_time'])
-		else:
-			span, value = 0, 0
-		if int(value) > 1:
-			span += 's'
-		if killed == 0 and lost == 0:
-			span = 'never'
-			value = ''
-
-		corp_id = char_info['corporation_id']
-		output += '{name} ({security:.2f}) [{killed}/{lost}] Last active {value} {span} ago\n'.format(
-				name=char_info['name'], security=char_info['security_status'],
-				killed=killed, lost=lost, value=value, span=span)
-
-	if 'corporations' in initial_id or char_info:
-		if not char_info:
-			corp_id = initial_id['corporations'][0]['id']
-		corp_info, active_members = get_corp_info(corp_id)
-		alliance_id = corp_info.get('alliance_id')
-		output += '{name} [{ticker}] {active} active members\n'.format(
-				name=corp_info['name'], ticker=corp_info['ticker'], active=active_members)
-
-	if 'alliances' in initial_id or alliance_id is not None:
-		if alliance_id is None:
-			alliance_id = initial_id['alliances'][0]['id']
-		alliance_info, active_members = get_alliance_info(alliance_id)
-		output += '{name} <{ticker}> {active} active members'.format(
-				name=alliance_info['name'], ticker=alliance_info['ticker'], active=active_members)
+	output = ''
+	try:
+		if char_id is not None:
+			char_info = futures['char'].result()
+			corp_id = char_info['corporation_id']
+			alliance_id = char_info.get('alliance_id')
+		if corp_id is not None:
+			start('corp', get_esi, 'corporations', corp_id)
+			start('corp_stats', get_zkill_stats, corp_id, 1)
+		if alliance_id is not None:
+			start('alliance', get_esi, 'alliances', alliance_id)
+			start('alliance_stats', get_zkill_stats, alliance_id, 2)
+
+		if char_id is not None:
+			killed, lost = get_kills_losses(futures['char_stats'].result())
+			last_active = futures['last_active'].result()
+			if last_active is not None:
+				span, value = get_humanized_timedelta(last_active['killmail_time'])
+			else:
+				span, value = 0, 0
+			if int(value) > 1:
+				span += 's'
+			if killed == 0 and lost == 0:
+				span = 'never'
+				value = ''
+			output += '{name} ({security:.2f}) [{killed}/{lost}] Last active {value} {span} ago\n'.format(
+					name=char_info['name'], security=char_info['security_status'],
+					killed=killed, lost=lost, value=value, span=span)
+
+		if corp_id is not None:
+			corp_info = futures['corp'].result()
+			if alliance_id is None and corp_info.get('alliance_id') is not None:
+				alliance_id = corp_info['alliance_id']
+				start('alliance', get_esi, 'alliances', alliance_id)
+				start('alliance_stats', get_zkill_stats, alliance_id, 2)
+			output += '{name} [{ticker}] {active} active members\n'.format(
+					name=corp_info['name'], ticker=corp_info['ticker'],
+					active=get_group_actives(futures['corp_stats'].result()))
+
+		if alliance_id is not None:
+			alliance_info = futures['alliance'].result()
+			output += '{name} <{ticker}> {active} active members'.format(
+					name=alliance_info['name'], ticker=alliance_info['ticker'],
+					active=get_group_actives(futures['alliance_stats'].result()))
+	except requests.exceptions.HTTPError:
+		cmd.reply("%s: couldn't find your sleazebag" % cmd.sender['username'])
+		return
 
 	cmd.reply('```' +output + '```')
@@ -0,0 +1,151 @@
+from array import array
+import bisect
+from collections import defaultdict
+
+# invTypes names, indexed once so item lookups don't scan the SDE with LOWER(...) LIKE. names are
+# casefolded; exact names and prefixes are found by bisecting the sorted names, and substrings and
+# typos through a trigram index. the index is built by extract and stored in the sde.py file
+
+class ItemIndex:
+	def __init__(self, sde):
+		# sde is an sde.SDE; everything below is built by extract
+		self.ids = sde.item_ids
+		self.names = sde.item_names
+		self.folded = sde.item_folded
+		self.market = sde.item_market # 1 for items that can be bought and sold
+		self.gram_counts = sde.item_gram_counts # distinct trigrams per name, for fuzzy scoring
+		self.sorted_names = sde.item_sorted_names
+		self.sorted_indexes = sde.item_sorted_indexes
+		# trigram -> indexes, ascending, are postings[offsets[g]:offsets[g+1]] for grams[g]
+		self.grams = sde.item_grams
+		self.gram_offsets = sde.item_gram_offsets
+		self.gram_postings = sde.item_gram_postings
+
+	def exact_match(self, query):
+		indexes = self._exact(query.casefold())
+		if not indexes:
+			return None
+		# a few names are shared by a market item and something unpublished
+		i = max(indexes, key=self.market.__getitem__)
+		return self._item(i)
+
+	def search(self, query, limit=3):
+		# market items whose names start with or contain query, best first: prefixes, then matches at
+		# the start of a word, then anywhere, preferring items over blueprints and shorter names
+		query = query.casefold()
+		matches = set(i for i in self._prefix(query) if self.market[i])
+		matches.update(i for i in self._substring(query) if self.market[i])
+
+		def rank(i):
+			name = self.folded[i]
+			position = name.find(query)
+			if position == 0:
+				kind = 0
+			elif name[position-1] == ' ':
+				kind = 1
+			else:
+				kind = 2
+			return kind, name.endswith(' blueprint'), len(name), name
+		return [self._item(i) for i in sorted(matches, key=rank)[:limit]]
+
+	def fuzzy(self, query, limit=3, threshold=0.4):
+		# market items containing the most of query's trigrams, for typos. ties go to the closer
+		# match overall (jaccard similarity), so "raaven" suggests Raven before Raven Navy Issue
+		grams = _trigrams(' %s ' % query.casefold())
+		shared = defaultdict(int)
+		for gram in grams:
+			for i in self._posting(gram):
+				shared[i] += 1
+		scored = []
+		for i, count in shared.items():
+			if not self.market[i] or count < threshold * len(grams):
+				continue
+			similarity = count / (len(grams) + self.gram_counts[i] - count)
+			scored.append((-count, -similarity, i))
+		scored.sort()
+		return [self._item(i) for _, _, i in scored[:limit]]
+
+	def _exact(self, query):
+		pos = bisect.bisect_left(self.sorted_names, query)
+		indexes = []
+		while pos < len(self.sorted_names) and self.sorted_names[pos] == query:
+			indexes.append(self.sorted_indexes[pos])
+			pos += 1
+		return indexes
+
+	def _posting(self, gram):
+		g = bisect.bisect_left(self.grams, gram)
+		if g == len(self.grams) or self.grams[g] != gram:
+			return ()
+		return self.gram_postings[self.gram_offsets[g]:self.gram_offsets[g+1]]
+
+	def _prefix(self, query):
+		start = bisect.bisect_left(self.sorted_names, query)
+		for pos in range(start, len(self.sorted_names)):
+			if not self.sorted_names[pos].startswith(query):
+				break
+			yield self.sorted_indexes[pos]
+
+	def _substring(self, query):
+		grams = _trigrams(query)
+		if not grams:
+			# too short for trigrams
+			return (i for i, name in enumerate(self.folded) if query in name)
+		postings = sorted((self._posting(gram) for gram in grams), key=len)
+		candidates = set(postings[0])
+		for posting in postings[1:]:
+			if not candidates:
+				break
+			candidates.intersection_update(posting)
+		# every trigram appearing somewhere in the name doesn't mean they appear in order
+		return (i for i in candidates if query in self.folded[i])
+
+	def _item(self, i):
+		return self.ids[i], self.names[i]
+
+def extract(db):
+	# the sections sde.py stores for ItemIndex
+	ids = array('q')
+	names = []
+	market = array('B')
+	curs = db.execute('''
+		SELECT "typeID", "typeName", "marketGroupID" IS NOT NULL FROM "invTypes"
+		WHERE "typeName" IS NOT NULL
+		''')
+	for type_id, name, is_market in curs:
+		ids.append(type_id)
+		names.append(name)
+		market.append(is_market)
+	folded = [name.casefold() for name in names]
+
+	trigrams = defaultdict(lambda: array('I'))
+	gram_counts = array('H')
+	for i, name in enumerate(folded):
+		# padded, so fuzzy matching sees where words start and end
+		grams = _trigrams(' %s ' % name)
+		gram_counts.append(len(grams))
+		for gram in grams:
+			trigrams[gram].append(i)
+	grams = sorted(trigrams)
+	gram_offsets = array('I', [0])
+	gram_postings = array('I')
+	for gram in grams:
+		gram_postings.extend(trigrams[gram])
+		gram_offsets.append(len(gram_postings))
+	order = sorted(range(len(folded)), key=folded.__getitem__)
+
+	return {
+		'item_ids': ids,
+		'item_names': names,
+		'item_folded': folded,
+		'item_market': market,
+		'item_gram_counts': gram_counts,
+		'item_sorted_names': [folded[i] for i in order],
+		'item_sorted_indexes': array('I', order),
+		'item_grams': grams,
+		'item_gram_offsets': gram_offsets,
+		'item_gram_postings': gram_postings,
+	}
+
+def _trigrams(s):
+	return set(s[i:i+3] for i in range(len(s) - 2))
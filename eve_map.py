@@ -0,0 +1,180 @@
+from array import array
+import bisect
+from collections import deque
+import functools
+import heapq
+
+import numpy as np
+
+# the stargate graph from the SDE, held in memory so !jumps doesn't need ESI. systems are numbered
+# 0..n-1 in order of id and each one's neighbours are neighbours[offsets[i]:offsets[i+1]]. the graph
+# is built by extract and stored in the sde.py file
+
+highsec = 0.45 # rounds to 0.5
+lowsec = 0.05 # anything lower rounds to 0.0
+avoid_cost = 1000 # per jump through the kind of space a secure or insecure route avoids
+meters_per_ly = 9.4605284e15
+grid_size = 5 # ly per side of the cubes systems are bucketed into for range queries
+
+class Map:
+	def __init__(self, sde):
+		# sde is an sde.SDE; the sections are built by extract
+		self.ids = sde.system_ids
+		self.names = sde.system_names
+		self.security = sde.system_security
+		self.sorted_names = sde.system_sorted_names # casefolded
+		self.sorted_indexes = sde.system_sorted_indexes
+		self.offsets = sde.system_offsets
+		self.neighbours = sde.system_neighbours
+
+		self.route = functools.lru_cache(maxsize=4096)(self._route)
+
+		self.coordinates = np.frombuffer(sde.system_coordinates, dtype=np.float64).reshape(-1, 3)
+		self.security_array = np.frombuffer(sde.system_security, dtype=np.float64)
+		# systems sorted by grid cell; cell -> (start, stop) into grid_order
+		cells = np.floor(self.coordinates / grid_size).astype(np.int64)
+		self.grid_order = np.lexsort((cells[:, 2], cells[:, 1], cells[:, 0]))
+		sorted_cells = cells[self.grid_order]
+		starts = np.flatnonzero(np.any(np.diff(sorted_cells, axis=0) != 0, axis=1)) + 1
+		starts = np.concatenate(([0], starts)) if len(sorted_cells) else starts
+		stops = np.append(starts[1:], len(sorted_cells))
+		self.grid = {}
+		for start, stop in zip(starts.tolist(), stops.tolist()):
+			self.grid[tuple(sorted_cells[start].tolist())] = (start, stop)
+
+	def resolve(self, names):
+		# for each name, the systems it could mean: the one with that exact name, or else every
+		# system whose name starts with it
+		results = []
+		for name in names:
+			name = name.casefold()
+			pos = bisect.bisect_left(self.sorted_names, name)
+			if pos < len(self.sorted_names) and self.sorted_names[pos] == name:
+				results.append([self.sorted_indexes[pos]])
+				continue
+			matches = []
+			while pos < len(self.sorted_names) and self.sorted_names[pos].startswith(name):
+				matches.append(self.sorted_indexes[pos])
+				pos += 1
+			results.append(matches)
+		return results
+
+	def distance(self, a, b):
+		return float(np.linalg.norm(self.coordinates[a] - self.coordinates[b]))
+
+	def within(self, i, radius):
+		# the other systems no more than radius ly from i, and how far they are, nearest first
+		center = self.coordinates[i]
+		low = np.floor((center - radius) / grid_size).astype(np.int64).tolist()
+		high = np.floor((center + radius) / grid_size).astype(np.int64).tolist()
+		chunks = []
+		for cx in range(low[0], high[0] + 1):
+			for cy in range(low[1], high[1] + 1):
+				for cz in range(low[2], high[2] + 1):
+					span = self.grid.get((cx, cy, cz))
+					if span is not None:
+						chunks.append(self.grid_order[span[0]:span[1]])
+		candidates = np.concatenate(chunks)
+		distances = np.sqrt(((self.coordinates[candidates] - center) ** 2).sum(axis=1))
+		keep = (distances <= radius) & (candidates != i)
+		candidates, distances = candidates[keep], distances[keep]
+		order = np.argsort(distances, kind='stable')
+		return candidates[order], distances[order]
+
+	def _route(self, start, end, flag='shortest', avoid=frozenset()):
+		# returns the systems from start to end inclusive, or None if end can't be reached. flag is
+		# shortest, secure (stay in highsec where possible) or insecure (stay out of it)
+		if start == end:
+			return [start]
+		if flag == 'shortest':
+			return self._bfs(start, end, avoid)
+		return self._dijkstra(start, end, flag == 'secure', avoid)
+
+	def _bfs(self, start, end, avoid):
+		previous = {start: None}
+		queue = deque([start])
+		while queue:
+			i = queue.popleft()
+			for j in self.neighbours[self.offsets[i]:self.offsets[i+1]]:
+				if j in previous or (j in avoid and j != end):
+					continue
+				previous[j] = i
+				if j == end:
+					return _path(previous, end)
+				queue.append(j)
+		return None
+
+	def _dijkstra(self, start, end, secure, avoid):
+		costs = {start: 0}
+		previous = {start: None}
+		heap = [(0, start)]
+		while heap:
+			cost, i = heapq.heappop(heap)
+			if i == end:
+				return _path(previous, end)
+			if cost > costs[i]:
+				continue # already reached more cheaply
+			for j in self.neighbours[self.offsets[i]:self.offsets[i+1]]:
+				if j in avoid and j != end:
+					continue
+				if (self.security[j] >= highsec) == secure:
+					new_cost = cost + 1
+				else:
+					new_cost = cost + avoid_cost
+				if new_cost < costs.get(j, new_cost + 1):
+					costs[j] = new_cost
+					previous[j] = i
+					heapq.heappush(heap, (new_cost, j))
+		return None
+
+def extract(db):
+	# the sections sde.py stores for Map
+	ids = array('q')
+	names = []
+	security = array('d')
+	regions = array('q')
+	coordinates = array('d') # ly
+	curs = db.execute('''
+		SELECT "solarSystemID", "solarSystemName", "security", "regionID", x, y, z FROM "mapSolarSystems"
+		ORDER BY "solarSystemID"
+		''')
+	for system_id, name, system_security, region_id, x, y, z in curs:
+		ids.append(system_id)
+		names.append(name)
+		security.append(system_security)
+		regions.append(region_id)
+		coordinates.extend((x / meters_per_ly, y / meters_per_ly, z / meters_per_ly))
+	index = {system_id: i for i, system_id in enumerate(ids)}
+	folded = [name.casefold() for name in names]
+	order = sorted(range(len(folded)), key=folded.__getitem__)
+
+	adjacent = [[] for _ in ids]
+	curs = db.execute('SELECT "fromSolarSystemID", "toSolarSystemID" FROM "mapSolarSystemJumps"')
+	for from_id, to_id in curs:
+		adjacent[index[from_id]].append(index[to_id])
+	offsets = array('I', [0])
+	neighbours = array('I')
+	for systems in adjacent:
+		neighbours.extend(sorted(set(systems)))
+		offsets.append(len(neighbours))
+
+	return {
+		'system_ids': ids,
+		'system_names': names,
+		'system_security': security,
+		'system_regions': regions,
+		'system_coordinates': coordinates,
+		'system_sorted_names': [folded[i] for i in order],
+		'system_sorted_indexes': array('I', order),
+		'system_offsets': offsets,
+		'system_neighbours': neighbours,
+	}
+
+def _path(previous, end):
+	path = []
+	i = end
+	while i is not None:
+		path.append(i)
+		i = previous[i]
+	path.reverse()
+	return path
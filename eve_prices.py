@@ -0,0 +1,155 @@
+from array import array
+import bisect
+import email.utils
+import json
+import math
+import os
+import threading
+import time
+
+import config
+import httpclient
+import log
+
+# ESI's average and adjusted prices for every market item, refreshed on a background thread and
+# kept on disk so a restart can answer !price straight away. each refresh builds a new Snapshot and
+# replaces the old one in a single assignment, so readers never see a half-built one. the one
+# PriceSnapshots lives here rather than in eve, which can be reloaded, so there's only ever one
+# refresher thread per process
+
+url = 'https://esi.evetech.net/latest/markets/prices/?datasource=tranquility'
+
+class Snapshot:
+	__slots__ = ('type_ids', 'average', 'adjusted', 'etag', 'expires', 'fetched')
+
+	def __init__(self, type_ids=None, average=None, adjusted=None, etag=None, expires=0, fetched=0):
+		# parallel arrays sorted by type id; nan where ESI has no price
+		self.type_ids = type_ids if type_ids is not None else array('l')
+		self.average = average if average is not None else array('d')
+		self.adjusted = adjusted if adjusted is not None else array('d')
+		self.etag = etag
+		self.expires = expires
+		self.fetched = fetched
+
+	def get(self, type_id):
+		# (average, adjusted) or None
+		i = bisect.bisect_left(self.type_ids, type_id)
+		if i == len(self.type_ids) or self.type_ids[i] != type_id:
+			return None
+		return self.average[i], self.adjusted[i]
+
+	@classmethod
+	def parse(cls, items, etag, expires):
+		items = sorted(items, key=lambda item: item['type_id'])
+		nan = float('nan')
+		return cls(array('l', [item['type_id'] for item in items]),
+				array('d', [item.get('average_price', nan) for item in items]),
+				array('d', [item.get('adjusted_price', nan) for item in items]),
+				etag, expires, time.time())
+
+	def save(self, filename):
+		# a JSON header line, then the raw arrays
+		header = {'count': len(self.type_ids), 'typecode': self.type_ids.typecode, 'etag': self.etag,
+				'expires': self.expires, 'fetched': self.fetched}
+		tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+		with open(tmp_filename, 'wb') as f:
+			f.write(json.dumps(header).encode('utf-8') + b'\n')
+			for values in (self.type_ids, self.average, self.adjusted):
+				f.write(values.tobytes())
+		os.replace(tmp_filename, filename)
+
+	@classmethod
+	def load(cls, filename):
+		with open(filename, 'rb') as f:
+			header = json.loads(f.readline().decode('utf-8'))
+			arrays = []
+			for typecode in (header['typecode'], 'd', 'd'):
+				values = array(typecode)
+				values.fromfile(f, header['count'])
+				arrays.append(values)
+		return cls(*arrays, etag=header['etag'], expires=header['expires'], fetched=header['fetched'])
+
+class PriceSnapshots:
+	min_interval = 60
+	max_interval = 2 * 60 * 60 # when ESI doesn't send Expires
+	startup_wait = 30 # seconds to wait for the first download when there's nothing on disk
+
+	def __init__(self, session, filename):
+		self.session = session
+		self.filename = filename
+		self.snapshot = Snapshot()
+		self.ready = threading.Event()
+		self.start_lock = threading.Lock()
+		self.thread = None
+		if filename is not None:
+			try:
+				self.snapshot = Snapshot.load(filename)
+				self.ready.set()
+			except FileNotFoundError:
+				pass
+			except (OSError, ValueError, EOFError) as e:
+				log.write('eve_prices: ignoring %s: %r' % (filename, e))
+
+	def get(self, type_id):
+		self._start()
+		if not self.ready.is_set():
+			self.ready.wait(self.startup_wait)
+		return self.snapshot.get(type_id)
+
+	def age(self):
+		if not self.snapshot.fetched:
+			return None
+		return time.time() - self.snapshot.fetched
+
+	def _start(self):
+		# started on first use, in whichever process ends up running commands
+		with self.start_lock:
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self._run, name='eve prices', daemon=True)
+				self.thread.start()
+
+	def _run(self):
+		failures = 0
+		while True:
+			delay = self.snapshot.expires - time.time()
+			if delay > 0:
+				time.sleep(min(max(delay, self.min_interval), self.max_interval))
+			try:
+				self.refresh()
+				failures = 0
+			except Exception as e:
+				failures += 1
+				log.write('eve_prices: refresh failed (%d in a row): %r' % (failures, e))
+				time.sleep(min(self.min_interval * 2 ** failures, self.max_interval))
+			finally:
+				self.ready.set()
+
+	def refresh(self):
+		old = self.snapshot
+		headers = {}
+		if old.etag is not None:
+			headers['If-None-Match'] = old.etag
+		r = self.session.get(url, headers=headers, timeout=60)
+		expires = time.time() + self.max_interval
+		if 'Expires' in r.headers:
+			expires = email.utils.parsedate_to_datetime(r.headers['Expires']).timestamp()
+		if r.status_code == 304:
+			snapshot = Snapshot(old.type_ids, old.average, old.adjusted, old.etag, expires, time.time())
+		else:
+			r.raise_for_status()
+			snapshot = Snapshot.parse(r.json(), r.headers.get('ETag'), expires)
+		self.snapshot = snapshot
+		if self.filename is not None:
+			snapshot.save(self.filename)
+
+def format_price(prices):
+	if prices is None or math.isnan(prices[0]):
+		return 'n/a'
+	average, adjusted = prices
+	if average < 1000.0:
+		return 'avg %g adj %g' % (average, adjusted)
+	if math.isnan(adjusted):
+		return 'avg {:,d} adj n/a'.format(int(average))
+	return 'avg {:,d} adj {:,d}'.format(int(average), int(adjusted))
+
+snapshots = PriceSnapshots(httpclient.session, config.bot.esi_prices)
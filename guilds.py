@@ -0,0 +1,129 @@
+# compact caches of the guild data the bot actually uses, kept current from gateway events.
+# discord sends much more per role and channel (colors, permissions, overwrites, topics); we drop it
+
+class Role:
+	__slots__ = ('id', 'name', 'position')
+
+	def __init__(self, d):
+		self.id = d['id']
+		self.name = d['name']
+		self.position = d['position']
+
+	def __repr__(self):
+		return 'Role(%s, %r, %d)' % (self.id, self.name, self.position)
+
+class Guild:
+	__slots__ = ('id', 'name', 'roles', 'roles_by_id', 'channels')
+
+	# command threads read roles while the event loop handles role events, so the role dicts are
+	# never changed in place: every change builds new ones and swaps them in
+	def __init__(self, d):
+		self.id = d['id']
+		self.name = d['name']
+		self.channels = set() # channel ids
+		self._set_roles(d['roles'])
+
+	def update(self, d):
+		self.name = d['name']
+		# GUILD_UPDATE carries the full role list; anything missing from it is gone
+		self._set_roles(d['roles'])
+
+	def add_role(self, d):
+		roles = dict(self.roles)
+		roles_by_id = dict(self.roles_by_id)
+		old = roles_by_id.get(d['id'])
+		if old is not None and old.name != d['name'] and roles.get(old.name) is old:
+			_unindex_name(roles, roles_by_id, old)
+		role = Role(d)
+		roles_by_id[role.id] = role
+		roles[role.name] = role
+		self.roles_by_id = roles_by_id
+		self.roles = roles
+
+	def remove_role(self, role_id):
+		if role_id not in self.roles_by_id:
+			return
+		roles = dict(self.roles)
+		roles_by_id = dict(self.roles_by_id)
+		role = roles_by_id.pop(role_id)
+		if roles.get(role.name) is role:
+			_unindex_name(roles, roles_by_id, role)
+		self.roles_by_id = roles_by_id
+		self.roles = roles
+
+	def _set_roles(self, role_dicts):
+		roles = {} # name -> Role
+		roles_by_id = {} # id -> Role
+		for d in role_dicts:
+			role = Role(d)
+			roles_by_id[role.id] = role
+			roles[role.name] = role
+		self.roles_by_id = roles_by_id
+		self.roles = roles
+
+def _unindex_name(roles, roles_by_id, role):
+	del roles[role.name]
+	# role names aren't unique; fall back to another role with the same name if there is one
+	for other in roles_by_id.values():
+		if other.name == role.name and other is not role:
+			roles[other.name] = other
+			break
+
+class Cache:
+	def __init__(self):
+		self.guilds = {} # guild id -> Guild
+		self.channels = {} # channel id -> guild id
+
+	def guild_create(self, d):
+		old = self.guilds.get(d['id'])
+		if old is not None:
+			self._drop_channels(old)
+		guild = Guild(d)
+		self.guilds[guild.id] = guild
+		for channel in d['channels']:
+			self._add_channel(guild, channel['id'])
+		return guild
+
+	def guild_update(self, d):
+		guild = self.guilds.get(d['id'])
+		if guild is not None:
+			guild.update(d)
+
+	def guild_delete(self, d):
+		if d.get('unavailable'):
+			# an outage, not a removal. discord sends GUILD_CREATE when it comes back
+			return
+		guild = self.guilds.pop(d['id'], None)
+		if guild is not None:
+			self._drop_channels(guild)
+
+	def role_create(self, d):
+		guild = self.guilds.get(d['guild_id'])
+		if guild is not None:
+			guild.add_role(d['role'])
+
+	role_update = role_create
+
+	def role_delete(self, d):
+		guild = self.guilds.get(d['guild_id'])
+		if guild is not None:
+			guild.remove_role(d['role_id'])
+
+	def channel_create(self, d):
+		guild = self.guilds.get(d.get('guild_id')) # DM channels have no guild
+		if guild is not None:
+			self._add_channel(guild, d['id'])
+
+	def channel_delete(self, d):
+		guild_id = self.channels.pop(d['id'], None)
+		if guild_id is not None and guild_id in self.guilds:
+			self.guilds[guild_id].channels.discard(d['id'])
+
+	def _add_channel(self, guild, channel_id):
+		guild.channels.add(channel_id)
+		self.channels[channel_id] = guild.id
+
+	def _drop_channels(self, guild):
+		for channel_id in guild.channels:
+			if self.channels.get(channel_id) == guild.id:
+				del self.channels[channel_id]
@@ -0,0 +1,216 @@
+import collections
+import email.utils
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+
+import config
+
+# the one HTTP client every command module goes through: a pooled requests.Session, a cache that
+# follows Cache-Control/Expires and revalidates with ETag/Last-Modified, and singleflight, so
+# identical GETs made at the same time share one request
+
+user_agent = 'sbot (github.com/raylu/sbot)'
+default_timeout = 30
+
+session = requests.Session()
+session.headers['User-Agent'] = user_agent
+# commands run on up to dispatch.workers * 2 threads, plus eve.who's pool
+_adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
+
+def get(url, params=None, headers=None, **kwargs):
+	kwargs.setdefault('timeout', default_timeout)
+	if (headers and 'Authorization' in headers) or kwargs.get('stream') or 'auth' in kwargs:
+		# per-user responses aren't cached or shared
+		return session.get(url, params=params, headers=headers, **kwargs)
+	url = requests.Request('GET', url, params=params).prepare().url
+	key = url
+	if headers:
+		key += ' ' + json.dumps(sorted(headers.items()))
+
+	with _inflight_lock:
+		call = _inflight.get(key)
+		leader = call is None
+		if leader:
+			call = _inflight[key] = _Call()
+	if not leader:
+		call.done.wait()
+		if call.error is not None:
+			raise call.error
+		return call.response
+
+	try:
+		call.response = _get(key, url, headers, kwargs)
+		return call.response
+	except Exception as e:
+		call.error = e
+		raise
+	finally:
+		with _inflight_lock:
+			del _inflight[key]
+		call.done.set()
+
+def post(url, **kwargs):
+	kwargs.setdefault('timeout', default_timeout)
+	return session.post(url, **kwargs)
+
+class _Call:
+	__slots__ = ('done', 'response', 'error')
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.response = None
+		self.error = None
+
+_inflight = {} # key -> _Call
+_inflight_lock = threading.Lock()
+
+def _get(key, url, headers, kwargs):
+	entry = cache.get(key)
+	now = time.time()
+	if entry is not None and entry.expires > now:
+		return entry.response()
+
+	request_headers = dict(headers or {})
+	if entry is not None:
+		if entry.etag is not None:
+			request_headers['If-None-Match'] = entry.etag
+		if entry.last_modified is not None:
+			request_headers['If-Modified-Since'] = entry.last_modified
+	r = session.get(url, headers=request_headers, **kwargs)
+	now = time.time()
+	if r.status_code == 304 and entry is not None:
+		expires = _expires(r.headers, now)
+		entry.expires = now if expires is None else expires
+		cache.put(key, entry)
+		return entry.response()
+	if r.status_code == 200:
+		expires = _expires(r.headers, now)
+		etag = r.headers.get('ETag')
+		last_modified = r.headers.get('Last-Modified')
+		if expires is not None and (expires > now or etag is not None or last_modified is not None):
+			cache.put(key, _Entry(r.url, dict(r.headers), r.content, expires, etag, last_modified))
+	return r
+
+def _expires(headers, now):
+	# when a response stops being fresh, or None if it mustn't be stored
+	directives = {}
+	for directive in headers.get('Cache-Control', '').split(','):
+		name, _, value = directive.strip().partition('=')
+		directives[name.lower()] = value.strip('"')
+	if 'no-store' in directives:
+		return None
+	if 'no-cache' in directives:
+		return now
+	if 'max-age' in directives:
+		try:
+			age = int(headers.get('Age', 0))
+			return now + int(directives['max-age']) - age
+		except ValueError:
+			return now
+	if 'Expires' in headers:
+		try:
+			expires = email.utils.parsedate_to_datetime(headers['Expires']).timestamp()
+			# relative to the server's clock, not ours
+			date = email.utils.parsedate_to_datetime(headers['Date']).timestamp() if 'Date' in headers else now
+		except (TypeError, ValueError):
+			return now
+		return now + expires - date
+	return now
+
+class _Entry:
+	__slots__ = ('url', 'headers', 'content', 'expires', 'etag', 'last_modified')
+
+	def __init__(self, url, headers, content, expires, etag, last_modified):
+		self.url = url
+		self.headers = headers
+		self.content = content
+		self.expires = expires
+		self.etag = etag
+		self.last_modified = last_modified
+
+	def response(self):
+		r = requests.Response()
+		r.status_code = 200
+		r.reason = 'OK'
+		r.url = self.url
+		r.headers = requests.structures.CaseInsensitiveDict(self.headers)
+		r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+		r._content = self.content
+		return r
+
+	def dump(self):
+		header = {'url': self.url, 'headers': self.headers, 'expires': self.expires, 'etag': self.etag,
+				'last_modified': self.last_modified}
+		return json.dumps(header).encode('utf-8') + b'\n' + self.content
+
+	@classmethod
+	def load(cls, data):
+		header, _, content = data.partition(b'\n')
+		header = json.loads(header.decode('utf-8'))
+		return cls(header['url'], header['headers'], content, header['expires'], header['etag'],
+				header['last_modified'])
+
+class Cache:
+	# least recently used responses up to max_bytes of bodies in memory, and optionally every
+	# response on disk too, so a restart doesn't start cold
+	def __init__(self, max_bytes, directory=None):
+		self.max_bytes = max_bytes
+		self.directory = directory
+		self.entries = collections.OrderedDict() # key -> _Entry
+		self.size = 0
+		self.lock = threading.Lock()
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+				return entry
+		if self.directory is None:
+			return None
+		try:
+			with open(self._filename(key), 'rb') as f:
+				entry = _Entry.load(f.read())
+		except (OSError, ValueError, KeyError): # missing, or written by an older version
+			return None
+		self._remember(key, entry)
+		return entry
+
+	def put(self, key, entry):
+		self._remember(key, entry)
+		if self.directory is not None:
+			filename = self._filename(key)
+			tmp_filename = '%s.%d.%d' % (filename, os.getpid(), threading.get_ident())
+			with open(tmp_filename, 'wb') as f:
+				f.write(entry.dump())
+			os.replace(tmp_filename, filename)
+
+	def _remember(self, key, entry):
+		if len(entry.content) > self.max_bytes // 4:
+			return
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.size -= len(old.content)
+			self.entries[key] = entry
+			self.size += len(entry.content)
+			while self.size > self.max_bytes:
+				_, evicted = self.entries.popitem(last=False)
+				self.size -= len(evicted.content)
+
+	def _filename(self, key):
+		return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+cache = Cache(**config.bot.http_cache)
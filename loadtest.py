@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+from collections import defaultdict, deque
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from aiohttp import web
+
+from bot import Bot
+import config
+import recording
+import rest
+
+# runs an unmodified Bot (in a child process) against a fake gateway and REST API, then reports
+# event throughput, command reply latency and REST calls per event
+
+def main():
+	parser = argparse.ArgumentParser(description='load test the bot against a fake discord')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--timeout', type=float, default=30,
+			help='seconds to wait for the bot to catch up after the last event')
+	subparsers = parser.add_subparsers(dest='mode')
+	replay = subparsers.add_parser('replay', help='replay a recording made with record_gateway')
+	replay.add_argument('recording')
+	replay.add_argument('--speed', type=float, default=0,
+			help='playback speed relative to the recording; 0 sends as fast as possible')
+	synthetic = subparsers.add_parser('synthetic', help='generate guilds and messages')
+	synthetic.add_argument('--guilds', type=int, default=100)
+	synthetic.add_argument('--channels', type=int, default=10, help='channels per guild')
+	synthetic.add_argument('--rate', type=float, default=200, help='messages per second')
+	synthetic.add_argument('--duration', type=float, default=30, help='seconds of messages')
+	synthetic.add_argument('--commands', type=float, default=0.01, help='fraction of messages that are commands')
+	args = parser.parse_args()
+
+	if args.mode == 'replay':
+		events = replay_events(args.recording, args.speed)
+	elif args.mode == 'synthetic':
+		events = synthetic_events(args.guilds, args.channels, args.rate, args.duration, args.commands)
+	else:
+		parser.error('choose replay or synthetic')
+
+	base_url = 'http://127.0.0.1:%d' % args.port
+	bot_process = multiprocessing.get_context('fork').Process(target=run_bot,
+			args=('ws://127.0.0.1:%d/gateway' % args.port, base_url + '/api'))
+	bot_process.start()
+	fake = FakeDiscord(events, args.timeout)
+	loop = asyncio.get_event_loop()
+	runner = loop.run_until_complete(fake.start(args.port))
+	try:
+		loop.run_until_complete(fake.finished.wait())
+	finally:
+		bot_process.terminate()
+		loop.run_until_complete(runner.cleanup())
+	fake.report()
+
+def run_bot(gateway_url, api_url):
+	asyncio.set_event_loop(asyncio.new_event_loop())
+	config.bot.token = 'loadtest'
+	config.bot.api_url = api_url
+	config.bot.gateway_encoding = 'json' # the fake gateway only speaks json
+	config.bot.err_channel = None
+	config.bot.timer_channel = None
+	config.bot.zkillboard = None
+	config.bot.warframe = None
+	config.bot.autoreload = False
+	config.bot.record_gateway = None
+	config.bot.debug = False
+	# keep the fake gateway url and anything else the bot saves out of the real state.yaml
+	config.state = config.State(os.path.join(tempfile.mkdtemp(), 'state.yaml'), config.state_defaults)
+	config.state.gateway_url = gateway_url
+	bot = Bot(EchoCommands())
+	bot.connect()
+	bot.run_forever()
+
+# every trigger is a command that replies straight away, so replies time the bot and not whatever
+# APIs the real commands call
+class EchoCommands(dict):
+	def get(self, key, default=None):
+		return echo
+
+	def __missing__(self, key):
+		return echo
+
+def echo(cmd):
+	cmd.reply('ack')
+
+def replay_events(filename, speed):
+	for offset, raw_data in recording.read(filename):
+		data = json.loads(raw_data)
+		if data['op'] != 0: # HELLO, heartbeat ACKs and the like come from the fake gateway itself
+			continue
+		yield (offset / speed if speed else 0), {'t': data['t'], 'd': data['d']}
+
+def synthetic_events(guild_count, channel_count, rate, duration, command_ratio):
+	ids = itertools.count(300000000000000000)
+	yield 0, {'t': 'READY', 'd': {'user': {'id': str(next(ids)), 'username': 'sbot'},
+			'session_id': 'loadtest', 'guilds': []}}
+	channels = []
+	for _ in range(guild_count):
+		guild_id = str(next(ids))
+		guild_channels = [str(next(ids)) for _ in range(channel_count)]
+		channels.extend((guild_id, channel_id) for channel_id in guild_channels)
+		roles = [{'id': guild_id, 'name': '@everyone', 'position': 0}]
+		for position, name in enumerate(['humans', 'bots', 'sbot'], 1):
+			roles.append({'id': str(next(ids)), 'name': name, 'position': position})
+		yield 0, {'t': 'GUILD_CREATE', 'd': {'id': guild_id, 'name': 'guild %s' % guild_id,
+				'roles': roles, 'channels': [{'id': c, 'name': 'general'} for c in guild_channels]}}
+
+	for i in range(int(rate * duration)):
+		guild_id, channel_id = random.choice(channels)
+		if random.random() < command_ratio:
+			content = '!ping %d' % i
+		else:
+			content = 'just chatting about nothing in particular %d' % i
+		yield i / rate, {'t': 'MESSAGE_CREATE', 'd': {
+			'id': str(next(ids)), 'channel_id': channel_id, 'guild_id': guild_id, 'content': content,
+			'author': {'id': '109405765848088576', 'username': 'loadtest', 'discriminator': '0001'},
+		}}
+
+class FakeDiscord:
+	heartbeat_interval = 250 # ms. frequent heartbeats tell us how far the bot has read
+
+	def __init__(self, events, timeout):
+		self.events = events
+		self.timeout = timeout
+		self.url = None
+		self.ws = None
+		self.traffic = None
+		self.seq = 0
+		self.acked_seq = None
+		self.started = None
+		self.traffic_done = None
+		self.caught_up = None
+		self.finished = asyncio.Event()
+		self.pending = defaultdict(deque) # channel id -> when each unanswered command was sent
+		self.commands = 0
+		self.latencies = []
+		self.rest_calls = defaultdict(int) # route -> calls
+
+	async def start(self, port):
+		self.url = 'ws://127.0.0.1:%d/gateway' % port
+		app = web.Application()
+		app.router.add_get('/gateway', self.gateway)
+		app.router.add_route('*', '/api/{path:.*}', self.api)
+		runner = web.AppRunner(app)
+		await runner.setup()
+		await web.TCPSite(runner, '127.0.0.1', port).start()
+		return runner
+
+	async def gateway(self, request):
+		ws = web.WebSocketResponse(max_msg_size=0)
+		await ws.prepare(request)
+		self.ws = ws
+		await self._send({'op': 10, 's': None, 't': None,
+				'd': {'heartbeat_interval': self.heartbeat_interval, '_trace': ['loadtest']}})
+		async for msg in ws:
+			data = json.loads(msg.data)
+			if data['op'] in (2, 6) and self.traffic is None: # IDENTIFY or RESUME
+				self.traffic = asyncio.ensure_future(self.send_traffic())
+			elif data['op'] == 6:
+				await self._send({'op': 0, 's': None, 't': 'RESUMED', 'd': {}})
+			elif data['op'] == 1:
+				self.acked_seq = data['d']
+				await self._send({'op': 11, 's': None, 't': None, 'd': None})
+				self._check_finished()
+		return ws
+
+	async def send_traffic(self):
+		self.started = time.monotonic()
+		for offset, event in self.events:
+			delay = self.started + offset - time.monotonic()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			self.seq += 1
+			d = event['d']
+			if event['t'] == 'MESSAGE_CREATE' and (d['content'].startswith('!') or d['content'] == 'oh no.'):
+				self.commands += 1
+				self.pending[d['channel_id']].append(time.monotonic())
+			await self._send({'op': 0, 's': self.seq, 't': event['t'], 'd': d})
+		self.traffic_done = time.monotonic()
+		asyncio.get_event_loop().call_later(self.timeout, self.finished.set)
+
+	async def api(self, request):
+		path = '/' + request.match_info['path']
+		route = str(rest.Route(request.method, path))
+		self.rest_calls[route] += 1
+		if path == '/gateway/bot':
+			return web.json_response({'url': self.url, 'shards': 1})
+		if request.method == 'POST' and path.endswith('/messages'):
+			data = await request.json()
+			channel_id = path.split('/')[2]
+			now = time.monotonic()
+			# the bot merges queued replies into one message, one line each
+			for _ in range(data['content'].count('\n') + 1):
+				if self.pending[channel_id]:
+					self.latencies.append(now - self.pending[channel_id].popleft())
+			self._check_finished()
+			return web.json_response({'id': '1', 'channel_id': channel_id, 'content': data['content']})
+		return web.Response(status=204)
+
+	async def _send(self, data):
+		# compact, like discord's, so the bot's prefilter sees what it would in production
+		await self.ws.send_str(json.dumps(data, separators=(',', ':')))
+
+	def _check_finished(self):
+		if self.traffic_done is None or self.acked_seq is None or self.acked_seq < self.seq:
+			return
+		if self.caught_up is None:
+			self.caught_up = time.monotonic()
+		if not any(self.pending.values()):
+			self.finished.set()
+
+	def report(self):
+		if self.started is None:
+			print('the bot never identified')
+			return
+		end = self.caught_up or time.monotonic()
+		elapsed = end - self.started
+		print('events:   %d in %.2fs, %.0f events/s (sending took %.2fs)' % (
+				self.seq, elapsed, self.seq / elapsed, (self.traffic_done or end) - self.started))
+		if self.caught_up is None:
+			print('          the bot had only read up to seq %s of %d' % (self.acked_seq, self.seq))
+		unanswered = sum(len(p) for p in self.pending.values())
+		print('commands: %d, %d unanswered' % (self.commands, unanswered))
+		if self.latencies:
+			latencies = sorted(self.latencies)
+			print('latency:  p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms' % tuple(
+					percentile(latencies, p) * 1000 for p in (50, 90, 99, 100)))
+		rest_total = sum(self.rest_calls.values())
+		print('rest:     %d calls, %.4f per event' % (rest_total, rest_total / max(self.seq, 1)))
+		for route, calls in sorted(self.rest_calls.items(), key=lambda item: -item[1]):
+			print('          %6d %s' % (calls, route))
+
+def percentile(values, p):
+	index = min(len(values) - 1, int(len(values) * p / 100))
+	return values[index]
+
+if __name__ == '__main__':
+	main()
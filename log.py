@@ -1,22 +1,120 @@
+import atexit
+from collections import deque
 from datetime import datetime
+import json
+import os
 import sys
+import threading
+import time
 
-logfile = open('sbot.log', 'a')
+filename = 'sbot.log'
 stdout = sys.stdout.isatty()
+options = {
+	'max_bytes': 10 * 1024 * 1024, # rotate once the file is this big
+	'rotate_interval': None, # or rotate after this many seconds
+	'backups': 5,
+	'structured': False, # JSON lines instead of text
+	'flush_interval': 0.5,
+}
 
-def write(text):
-	line = '%s %s' % (datetime.now(), text)
+# write() only appends here and a background thread does the formatting and the disk writes, so
+# logging never blocks the gateway. deque appends are atomic; under a long enough error storm the
+# oldest records are dropped instead of growing without bound
+records = deque(maxlen=100000)
+lock = threading.Lock() # held while records are written out
+logfile = open(filename, 'a')
+opened_at = time.time()
+
+def configure(**kwargs):
+	options.update(kwargs)
+
+def reopen(name):
+	# rotation isn't coordinated between processes, so each forked shard writes its own file
+	global filename, logfile, opened_at
+	with lock:
+		_drain()
+		logfile.close()
+		filename = name
+		logfile = open(filename, 'a')
+		opened_at = time.time()
+
+def write(text, **fields):
+	records.append((time.time(), text, fields))
+
+def flush():
+	with lock:
+		_drain()
+		logfile.flush()
+
+def close():
+	flush()
+	logfile.close()
+
+def _drain():
+	lines = []
+	while records:
+		lines.append(_format(*records.popleft()))
+	if not lines:
+		return
+	output = ''.join(lines)
+	if stdout:
+		print(output, end='')
+	logfile.write(output)
+	_maybe_rotate()
+
+def _format(ts, text, fields):
+	dt = datetime.fromtimestamp(ts)
+	if options['structured']:
+		record = {'ts': dt.isoformat(), 'pid': os.getpid(), 'msg': str(text)}
+		record.update(fields)
+		return json.dumps(record, default=str) + '\n'
+
+	line = '%s %s' % (dt, text)
+	if fields:
+		line += ' ' + ' '.join('%s=%s' % item for item in sorted(fields.items()))
 	if 0 <= line.rfind('\n') < len(line)-1:
 		line += '\n\n'
 	else:
 		line += '\n'
+	return line
 
-	if stdout:
-		print(line, end='')
-	logfile.write(line)
+def _maybe_rotate():
+	global logfile, opened_at
 
-def flush():
-	logfile.flush()
-
-def close():
+	too_big = logfile.tell() >= options['max_bytes']
+	too_old = options['rotate_interval'] is not None and time.time() - opened_at >= options['rotate_interval']
+	if not too_big and not too_old:
+		return
 	logfile.close()
+	for i in range(options['backups'] - 1, 0, -1):
+		if os.path.exists('%s.%d' % (filename, i)):
+			os.replace('%s.%d' % (filename, i), '%s.%d' % (filename, i + 1))
+	if options['backups'] > 0:
+		os.replace(filename, filename + '.1')
+	else:
+		os.remove(filename)
+	logfile = open(filename, 'a')
+	opened_at = time.time()
+
+def _run():
+	while True:
+		time.sleep(options['flush_interval'])
+		try:
+			flush()
+		except Exception as e:
+			print('error writing log: %r' % e, file=sys.stderr)
+
+def _start_writer():
+	threading.Thread(target=_run, name='log writer', daemon=True).start()
+
+def _after_fork():
+	global lock
+	# the parent flushed right before forking and will write anything it had queued itself
+	records.clear()
+	lock = threading.Lock()
+	_start_writer()
+
+_start_writer()
+atexit.register(flush)
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(before=flush, after_in_child=_after_fork)
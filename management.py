@@ -37,16 +37,16 @@ def _ids(cmd):
 	guild_id = bot.channels[cmd.channel_id]
 	roles = bot.guilds[guild_id].roles
 	try:
-		role_id = roles[cmd.args]['id']
+		role_id = roles[cmd.args].id
 		return guild_id, role_id
 	except KeyError:
 		return guild_id, None
 
 def _allowed_role_names(roles):
-	sbot_position = roles['sbot']['position']
+	sbot_position = roles['sbot'].position
 	arns = []
 	for role in roles.values():
 		# exclude roles higher than ours, @everyone (position 0), humans, and bots
-		if 0 < role['position'] < sbot_position and role['name'] not in ('humans', 'bots'):
-			arns.append(role['name'])
+		if 0 < role.position < sbot_position and role.name not in ('humans', 'bots'):
+			arns.append(role.name)
 	return arns
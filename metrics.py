@@ -0,0 +1,145 @@
+import bisect
+import time
+
+from aiohttp import web
+
+# metrics in the Prometheus text format. they're updated from the event loop thread unless their
+# definition says otherwise
+
+registry = []
+
+class Metric:
+	kind = None
+
+	def __init__(self, name, help_text, labels=()):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		registry.append(self)
+
+	def render(self):
+		lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s %s' % (self.name, self.kind)]
+		lines.extend(self.samples())
+		return lines
+
+	def samples(self):
+		raise NotImplementedError
+
+	def _label_str(self, values, extra=''):
+		pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(self.labels, values)]
+		if extra:
+			pairs.append(extra)
+		if not pairs:
+			return ''
+		return '{%s}' % ','.join(pairs)
+
+class Counter(Metric):
+	kind = 'counter'
+
+	def __init__(self, name, help_text, labels=()):
+		super().__init__(name, help_text, labels)
+		self.values = {}
+
+	def inc(self, *labels, amount=1):
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+	def samples(self):
+		for labels, value in sorted(self.values.items()):
+			yield '%s%s %s' % (self.name, self._label_str(labels), value)
+
+class Gauge(Metric):
+	kind = 'gauge'
+
+	def __init__(self, name, help_text, labels=(), func=None):
+		super().__init__(name, help_text, labels)
+		self.values = {}
+		self.func = func # called at scrape time; returns a value, or {labels: value} with labels
+
+	def set(self, value, *labels):
+		self.values[labels] = value
+
+	def samples(self):
+		values = self.values
+		if self.func is not None:
+			values = self.func()
+			if not self.labels:
+				values = {(): values}
+		for labels, value in sorted(values.items()):
+			yield '%s%s %s' % (self.name, self._label_str(labels), value)
+
+class Histogram(Metric):
+	kind = 'histogram'
+	default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+	def __init__(self, name, help_text, labels=(), buckets=default_buckets):
+		super().__init__(name, help_text, labels)
+		self.buckets = buckets
+		self.values = {} # labels -> [counts per bucket (+Inf last), sum]
+
+	def observe(self, value, *labels):
+		counts = self.values.get(labels)
+		if counts is None:
+			counts = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+		counts[0][bisect.bisect_left(self.buckets, value)] += 1
+		counts[1] += value
+
+	def samples(self):
+		for labels, (counts, total) in sorted(self.values.items()):
+			cumulative = 0
+			for bound, count in zip(self.buckets + (float('inf'),), counts):
+				cumulative += count
+				le = '+Inf' if bound == float('inf') else repr(bound)
+				yield '%s_bucket%s %d' % (self.name, self._label_str(labels, 'le="%s"' % le), cumulative)
+			yield '%s_sum%s %s' % (self.name, self._label_str(labels), total)
+			yield '%s_count%s %d' % (self.name, self._label_str(labels), cumulative)
+
+class Timer:
+	def __init__(self, histogram, *labels):
+		self.histogram = histogram
+		self.labels = labels
+		self.start = None
+
+	def __enter__(self):
+		self.start = time.monotonic()
+		return self
+
+	def __exit__(self, *exc):
+		self.histogram.observe(time.monotonic() - self.start, *self.labels)
+
+def _escape(value):
+	return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def render():
+	lines = []
+	for metric in registry:
+		lines.extend(metric.render())
+	return '\n'.join(lines) + '\n'
+
+async def _handle_metrics(request):
+	return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+			headers={'X-Content-Type-Options': 'nosniff'})
+
+async def serve(port):
+	app = web.Application()
+	app.router.add_get('/metrics', _handle_metrics)
+	runner = web.AppRunner(app)
+	await runner.setup()
+	site = web.TCPSite(runner, '127.0.0.1', port)
+	await site.start()
+	return runner
+
+gateway_events = Counter('sbot_gateway_events_total', 'gateway dispatch events received', ('type',))
+gateway_prefiltered = Counter('sbot_gateway_prefiltered_total',
+		'MESSAGE_CREATE events skipped without decoding because they are not commands')
+heartbeat_rtt = Histogram('sbot_heartbeat_rtt_seconds', 'time from heartbeat to HEARTBEAT_ACK')
+command_seconds = Histogram('sbot_command_seconds', 'command run time', ('command',))
+command_wait = Histogram('sbot_command_wait_seconds', 'time commands spent queued before running')
+commands_shed = Counter('sbot_commands_shed_total', 'commands refused because the queue was full')
+commands_timed_out = Counter('sbot_commands_timed_out_total', 'commands that ran past their deadline',
+		('command',))
+rest_seconds = Histogram('sbot_rest_seconds', 'discord REST call latency', ('route', 'status'))
+poller_seconds = Histogram('sbot_poller_seconds', 'time spent per background poller iteration', ('poller',))
+# observed wherever eve is imported: at startup, or on an executor thread when it's reloaded. that's
+# rare, and a scrape racing one sees the sample or doesn't
+sde_query_seconds = Histogram('sbot_sde_query_seconds', 'time to read each table of eve_db when building the SDE file',
+		('table',))
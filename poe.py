@@ -3,9 +3,7 @@
 import json
 import time
 
-import requests
-
-rs = requests.Session()
+import httpclient
 
 league_name = None
 
@@ -35,7 +33,7 @@ def price(cmd):
 		cmd.reply('\n'.join(responses))
 
 def _get_league_name():
-	html = rs.get('https://poe.ninja/')
+	html = httpclient.get('https://poe.ninja/')
 	prefix = 'window.leagues = '
 	for line in html.text.split('\n'):
 		if prefix in line:
@@ -93,6 +91,6 @@ def _query(page, league):
 		if ts > now - 60 * 60: # cache for 1 hour
 			return data
 
-	data = rs.get('https://poe.ninja/api/data/itemoverview?league=%s&type=%s' % (league, page)).json()
+	data = httpclient.get('https://poe.ninja/api/data/itemoverview?league=%s&type=%s' % (league, page)).json()
 	cache[(page, league)] = now, data
 	return data
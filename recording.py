@@ -0,0 +1,24 @@
+import gzip
+import time
+
+# gateway recordings: gzipped lines of "seconds since the recording started<TAB>payload"
+
+class Recorder:
+	def __init__(self, filename):
+		self.file = gzip.open(filename, 'at', encoding='utf-8')
+		self.start = time.monotonic()
+
+	def write(self, raw_data):
+		# raw newlines can only be whitespace between JSON tokens, never inside strings
+		self.file.write('%.3f\t%s\n' % (time.monotonic() - self.start, raw_data.replace('\n', ' ')))
+
+	def close(self):
+		self.file.close()
+
+def read(filename):
+	# yields (offset in seconds, payload). appending to a recording restarts its clock, so offsets
+	# only increase within one run of the bot
+	with gzip.open(filename, 'rt', encoding='utf-8') as f:
+		for line in f:
+			offset, raw_data = line.rstrip('\n').split('\t', 1)
+			yield float(offset), raw_data
@@ -1,9 +1,7 @@
-import requests
-
 import config
+import httpclient
 
-rs = requests.Session()
-rs.headers['User-Agent'] = 'python:sbot:v0 (by /u/raylu)'
+user_agent = 'python:sbot:v0 (by /u/raylu)'
 
 def headpat(cmd):
 	items = _reddit_request('/r/headpats/random')
@@ -24,18 +22,18 @@ def _reddit_request(path):
 	url = 'https://oauth.reddit.com' + path
 	access_token = config.state.reddit_access_token
 	if access_token is not None:
-		r = rs.get(url, headers={'Authorization': 'bearer ' + access_token})
+		r = httpclient.get(url, headers={'Authorization': 'bearer ' + access_token, 'User-Agent': user_agent})
 	if access_token is None or r.status_code == 401:
 		_refresh_access_token()
-		r = rs.get(url, headers={'Authorization': 'bearer ' + config.state.reddit_access_token})
+		r = httpclient.get(url, headers={'Authorization': 'bearer ' + config.state.reddit_access_token,
+				'User-Agent': user_agent})
 	r.raise_for_status()
 	return r.json()
 
 def _refresh_access_token():
-	r = rs.post('https://www.reddit.com/api/v1/access_token',
+	r = httpclient.post('https://www.reddit.com/api/v1/access_token', headers={'User-Agent': user_agent},
 			auth=(config.bot.reddit['api_id'], config.bot.reddit['api_secret']),
 			data={'grant_type': 'client_credentials'})
 	r.raise_for_status()
 	access_token = r.json()['access_token']
 	config.state.reddit_access_token = access_token
-	config.state.save()
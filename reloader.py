@@ -0,0 +1,80 @@
+import asyncio
+import importlib
+import os
+from os import path
+import sys
+import time
+import traceback
+
+import log
+import metrics
+
+# these hold the bot's live state (the gateway, queues, config, metrics) and can't be swapped out
+no_reload = {'__main__', 'bot', 'config', 'dispatch', 'eve_prices', 'httpclient', 'log', 'metrics', 'reloader', 'rest', 'shard', 'timers', 'zkill'}
+
+reload_seconds = metrics.Histogram('sbot_reload_seconds', 'module reload time', ('module',))
+reload_errors = metrics.Counter('sbot_reload_errors_total', 'module reloads that raised', ('module',))
+
+class Reloader:
+	interval = 1
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.root = path.dirname(path.abspath(__file__))
+		self.mtimes = self._scan() # module name -> mtime
+
+	async def run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			# one batch of stats per interval, on a thread so a slow disk doesn't stall the loop
+			mtimes = await self.bot.loop.run_in_executor(None, self._scan)
+			changed = [name for name, mtime in mtimes.items() if mtime > self.mtimes.get(name, mtime)]
+			self.mtimes = mtimes
+			if not changed:
+				continue
+			timings = await self.bot.loop.run_in_executor(None, self._reload, changed)
+			for name, elapsed in timings.items():
+				if elapsed is None:
+					reload_errors.inc(name)
+				else:
+					reload_seconds.observe(elapsed, name)
+			reloaded = {name for name, elapsed in timings.items() if elapsed is not None}
+			if reloaded:
+				self._swap(reloaded)
+
+	def _scan(self):
+		# every module of ours, not only ones with triggers: helpers like eve's get picked up too
+		mtimes = {}
+		for name, module in list(sys.modules.items()):
+			filename = getattr(module, '__file__', None)
+			if name in no_reload or filename is None or path.dirname(path.abspath(filename)) != self.root:
+				continue
+			try:
+				mtimes[name] = os.stat(filename).st_mtime
+			except OSError:
+				pass
+		return mtimes
+
+	def _reload(self, names):
+		timings = {} # module name -> seconds, or None if it failed
+		for name in names:
+			start = time.monotonic()
+			try:
+				importlib.reload(sys.modules[name])
+			except Exception:
+				log.write('error reloading %s:\n%s' % (name, traceback.format_exc()))
+				timings[name] = None
+				continue
+			timings[name] = time.monotonic() - start
+			log.write('reloaded %s in %.3fs' % (name, timings[name]))
+		return timings
+
+	def _swap(self, reloaded):
+		# build the new table on the side and replace it in one assignment so a command never sees
+		# triggers from two versions of the same module
+		commands = {}
+		for trigger, handler in self.bot.commands.items():
+			if handler.__module__ in reloaded:
+				handler = getattr(sys.modules[handler.__module__], handler.__name__, handler)
+			commands[trigger] = handler
+		self.bot.commands = commands
@@ -0,0 +1,130 @@
+import asyncio
+from collections import deque
+import re
+import time
+
+import log
+
+# discord's rate limits are per route, but routes are told apart by these "major parameters"
+major_re = re.compile(r'/(channels|guilds|webhooks)/(\d+)')
+id_re = re.compile(r'/\d+')
+
+class Route:
+	def __init__(self, method, path):
+		match = major_re.match(path)
+		self.major = match.group(0) if match else ''
+		self.key = '%s %s' % (method, id_re.sub('/{id}', path[len(self.major):]))
+
+	def __str__(self):
+		return self.key
+
+class RateLimiter:
+	def __init__(self):
+		self.buckets = {} # (bucket hash or route key, major) -> Bucket
+		self.hashes = {} # route key -> X-RateLimit-Bucket
+		self.global_reset = 0.0
+
+	async def acquire(self, route):
+		bucket_key = (self.hashes.get(route.key, route.key), route.major)
+		bucket = self.buckets.get(bucket_key)
+		if bucket is None:
+			bucket = self.buckets[bucket_key] = Bucket()
+		# requests in a bucket go out one at a time, in order
+		await bucket.lock.acquire()
+		try:
+			while True:
+				now = time.monotonic()
+				wait = self.global_reset - now
+				if bucket.remaining == 0 and bucket.reset > now:
+					wait = max(wait, bucket.reset - now)
+				if wait <= 0:
+					break
+				await asyncio.sleep(wait)
+		except:
+			bucket.lock.release()
+			raise
+		return bucket
+
+	def update(self, route, bucket, headers):
+		bucket_hash = headers.get('X-RateLimit-Bucket')
+		if bucket_hash is not None and self.hashes.get(route.key) != bucket_hash:
+			self.hashes[route.key] = bucket_hash
+			self.buckets.setdefault((bucket_hash, route.major), bucket)
+		remaining = headers.get('X-RateLimit-Remaining')
+		if remaining is not None:
+			bucket.remaining = int(remaining)
+		reset_after = headers.get('X-RateLimit-Reset-After')
+		if reset_after is not None:
+			bucket.reset = time.monotonic() + float(reset_after)
+		elif 'X-RateLimit-Reset' in headers:
+			bucket.reset = time.monotonic() + float(headers['X-RateLimit-Reset']) - time.time()
+
+	def limited(self, route, bucket, headers, body):
+		if 'Retry-After' in headers:
+			retry_after = float(headers['Retry-After'])
+		else:
+			retry_after = body.get('retry_after', 1000) / 1000 # v6 sends milliseconds
+		until = time.monotonic() + retry_after
+		if headers.get('X-RateLimit-Global') or body.get('global'):
+			self.global_reset = max(self.global_reset, until)
+		else:
+			bucket.remaining = 0
+			bucket.reset = until
+		log.write('rate limited on %s for %.2fs' % (route, retry_after))
+
+class Bucket:
+	def __init__(self):
+		self.lock = asyncio.Lock()
+		self.remaining = None
+		self.reset = 0.0
+
+	def release(self):
+		self.lock.release()
+
+# per-channel queue of outgoing messages. text-only messages that pile up behind a rate limit are
+# merged into as few messages as fit in discord's 2000 character limit
+class Outbox:
+	max_length = 2000
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.queues = {} # channel id -> deque of (data, future)
+
+	def put(self, channel_id, data):
+		future = self.bot.loop.create_future()
+		queue = self.queues.get(channel_id)
+		if queue is None:
+			queue = self.queues[channel_id] = deque()
+			self.bot.spawn(self._drain(channel_id, queue))
+		queue.append((data, future))
+		return future
+
+	def depth(self):
+		return sum(len(queue) for queue in self.queues.values())
+
+	async def _drain(self, channel_id, queue):
+		path = '/channels/%s/messages' % channel_id
+		try:
+			while queue:
+				data, future = queue.popleft()
+				futures = [future]
+				if set(data) == {'content'}:
+					content = data['content']
+					while queue and set(queue[0][0]) == {'content'} and \
+							len(content) + 1 + len(queue[0][0]['content']) <= self.max_length:
+						next_data, next_future = queue.popleft()
+						content += '\n' + next_data['content']
+						futures.append(next_future)
+					data = {'content': content}
+				try:
+					result = await self.bot.request('POST', path, data)
+				except Exception as e:
+					for f in futures:
+						if not f.cancelled():
+							f.set_exception(e)
+				else:
+					for f in futures:
+						if not f.cancelled():
+							f.set_result(result)
+		finally:
+			del self.queues[channel_id]
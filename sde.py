@@ -0,0 +1,179 @@
+from array import array
+import json
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import time
+import urllib.parse
+
+import eve_items
+import eve_map
+import log
+import metrics
+
+# the parts of the SDE the bot uses, pulled out of the (several hundred MB) sqlite dump into one
+# small file that's mapped straight into memory: market item names and ids, solar system names,
+# coordinates and security, and the stargate graph, along with the indexes eve_items and eve_map
+# search them with. every process maps the same file read-only, so they share its pages
+#
+# the file is a JSON header line, then each section aligned to 8 bytes. arrays are stored raw and
+# strings as an offsets array into a utf-8 blob. the header records the format version and the
+# dump's size and mtime; if either changes, the file is rebuilt
+
+version = 1
+magic = 'sbot sde'
+alignment = 8
+mmap_size = 1024 * 1024 * 1024 # of the dump sqlite may map while building
+cache_kib = 64 * 1024
+slow_query = 1 # seconds; slower queries are logged
+
+class SDE:
+	def __init__(self, filename):
+		with open(filename, 'rb') as f:
+			header_line = f.readline()
+			self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		header = json.loads(header_line.decode('utf-8'))
+		if header.get('magic') != magic:
+			raise ValueError('not an sde file')
+		self.version = header['version']
+		self.source = header['source']
+		if self.version != version:
+			return # load() will rebuild it
+
+		data = memoryview(self.mmap)[_align(len(header_line)):]
+		if len(data) < header['length']:
+			raise ValueError('truncated')
+		self.sections = {}
+		for name, section in header['sections'].items():
+			if section[0] == 'str':
+				_, (offsets_start, offsets_length), (blob_start, blob_length) = section
+				offsets = data[offsets_start:offsets_start + offsets_length].cast('I')
+				self.sections[name] = Strings(offsets, data[blob_start:blob_start + blob_length])
+			else:
+				typecode, start, section_length = section
+				self.sections[name] = data[start:start + section_length].cast(typecode)
+
+	def __getattr__(self, name):
+		try:
+			return self.__dict__['sections'][name]
+		except KeyError:
+			raise AttributeError(name)
+
+class Strings:
+	# a read-only sequence of str, decoded on access
+	__slots__ = ('offsets', 'blob')
+
+	def __init__(self, offsets, blob):
+		self.offsets = offsets
+		self.blob = blob
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		if not 0 <= i < len(self):
+			raise IndexError(i)
+		return str(self.blob[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+
+	def __iter__(self):
+		blob = self.blob
+		offsets = self.offsets
+		for i in range(len(offsets) - 1):
+			yield str(blob[offsets[i]:offsets[i+1]], 'utf-8')
+
+def load(db_filename, filename):
+	# the SDE file for the dump at db_filename, built first if it's missing or out of date
+	source = _source(db_filename)
+	try:
+		sde = SDE(filename)
+		if sde.version == version and sde.source == source:
+			return sde
+		log.write('sde: %s is out of date; rebuilding' % filename)
+	except FileNotFoundError:
+		pass
+	except (OSError, ValueError, KeyError) as e:
+		log.write('sde: rebuilding %s: %r' % (filename, e))
+	build(db_filename, filename)
+	return SDE(filename)
+
+def build(db_filename, filename):
+	source = _source(db_filename)
+	db = Connection(db_filename)
+	try:
+		sections = eve_items.extract(db)
+		sections.update(eve_map.extract(db))
+	finally:
+		db.close()
+
+	chunks = []
+	layout = {}
+	length = 0
+	def add(data):
+		nonlocal length
+		offset = length
+		chunks.append(data)
+		padding = -len(data) % alignment
+		if padding:
+			chunks.append(bytes(padding))
+		length += len(data) + padding
+		return offset, len(data)
+	for name, values in sorted(sections.items()):
+		if isinstance(values, array):
+			layout[name] = (values.typecode,) + add(values.tobytes())
+		else:
+			encoded = [value.encode('utf-8') for value in values]
+			offsets = array('I', [0])
+			for value in encoded:
+				offsets.append(offsets[-1] + len(value))
+			layout[name] = ('str', add(offsets.tobytes()), add(b''.join(encoded)))
+
+	header = {'magic': magic, 'version': version, 'source': source, 'length': length, 'sections': layout}
+	header_line = json.dumps(header).encode('utf-8') + b'\n'
+	tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+	with open(tmp_filename, 'wb') as f:
+		f.write(header_line)
+		f.write(bytes(-len(header_line) % alignment))
+		for chunk in chunks:
+			f.write(chunk)
+	# replacing rather than rewriting, so processes that have the old one mapped keep a whole file
+	os.replace(tmp_filename, filename)
+	log.write('sde: built %s from %s (%d bytes)' % (filename, db_filename, length))
+
+class Connection:
+	# a read-only connection to the dump for extract. immutable, so sqlite takes no locks and never
+	# creates a journal next to it; the dump is only ever replaced, and a replaced dump is a new file.
+	# each query's time is recorded by table
+	def __init__(self, db_filename):
+		uri = 'file:%s?mode=ro&immutable=1' % urllib.parse.quote(os.path.abspath(db_filename))
+		self.db = sqlite3.connect(uri, uri=True)
+		self.db.execute('PRAGMA mmap_size = %d' % mmap_size)
+		self.db.execute('PRAGMA cache_size = %d' % -cache_kib)
+
+	def execute(self, sql, params=()):
+		start = time.monotonic()
+		rows = self.db.execute(sql, params).fetchall()
+		elapsed = time.monotonic() - start
+		match = _table_re.search(sql)
+		metrics.sde_query_seconds.observe(elapsed, match.group(1) if match else '')
+		if elapsed >= slow_query:
+			log.write('sde: %.1fs, %d rows: %s' % (elapsed, len(rows), ' '.join(sql.split())))
+		return rows
+
+	def close(self):
+		self.db.close()
+
+_table_re = re.compile(r'FROM "(\w+)"')
+
+def _source(db_filename):
+	st = os.stat(db_filename)
+	return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def _align(n):
+	return n + -n % alignment
+
+if __name__ == '__main__':
+	build(sys.argv[1], sys.argv[2])
@@ -0,0 +1,105 @@
+from collections import defaultdict
+import multiprocessing
+import sys
+import time
+
+import requests
+
+from bot import Bot, FatalGatewayError
+import config
+import log
+
+FATAL_EXIT = 2
+
+def run(commands):
+	shard_count = config.bot.shards
+	if shard_count == 'auto' or config.state.gateway_url is None:
+		url, recommended = _gateway_bot()
+		config.state.gateway_url = url
+		if shard_count == 'auto':
+			shard_count = recommended
+
+	if shard_count == 1:
+		_run_shard(commands, 0, 1)
+	else:
+		Supervisor(commands, shard_count).run()
+
+def _gateway_bot():
+	r = requests.get(config.bot.api_url + '/gateway/bot', headers={
+		'Authorization': 'Bot ' + config.bot.token,
+		'User-Agent': 'DiscordBot (https://github.com/raylu/sbot 0.0',
+	})
+	r.raise_for_status()
+	data = r.json()
+	return data['url'], data['shards']
+
+def _run_shard(commands, shard_id, shard_count):
+	bot = Bot(commands, shard_id, shard_count)
+	try:
+		bot.connect()
+		bot.run_forever()
+	except FatalGatewayError as e:
+		log.write('shard %d: %s' % (shard_id, e))
+		sys.exit(FATAL_EXIT)
+	finally:
+		# forked shards skip atexit handlers, so write out whatever is still queued
+		log.flush()
+
+def _run_forked_shard(commands, shard_id, shard_count):
+	log.reopen('sbot.shard%d.log' % shard_id)
+	# the supervisor's state is from when it started; timers and reminders have changed since
+	config.state = config.State(config.state.filename, config.state_defaults)
+	_run_shard(commands, shard_id, shard_count)
+
+class Supervisor:
+	# discord allows one IDENTIFY every 5 seconds
+	identify_interval = 5
+
+	def __init__(self, commands, shard_count):
+		self.commands = commands
+		self.shard_count = shard_count
+		self.context = multiprocessing.get_context('fork')
+		self.processes = {} # shard id -> Process
+		self.started = {} # shard id -> monotonic time of the last start
+		self.failures = defaultdict(int) # shard id -> consecutive short-lived runs
+		self.restart_at = {} # shard id -> monotonic time to restart a dead shard
+
+	def run(self):
+		log.write('starting %d shards' % self.shard_count)
+		try:
+			for shard_id in range(self.shard_count):
+				self._start(shard_id)
+				time.sleep(self.identify_interval)
+			while True:
+				time.sleep(1)
+				self._check()
+		finally:
+			for process in self.processes.values():
+				process.terminate()
+
+	def _start(self, shard_id):
+		process = self.context.Process(target=_run_forked_shard, name='shard %d' % shard_id,
+				args=(self.commands, shard_id, self.shard_count))
+		process.start()
+		self.processes[shard_id] = process
+		self.started[shard_id] = time.monotonic()
+
+	def _check(self):
+		now = time.monotonic()
+		for shard_id, process in self.processes.items():
+			if process.is_alive():
+				continue
+			if process.exitcode == FATAL_EXIT:
+				raise Exception('shard %d exited with a fatal gateway error' % shard_id)
+
+			restart_at = self.restart_at.get(shard_id)
+			if restart_at is None:
+				if now - self.started[shard_id] > 600:
+					self.failures[shard_id] = 0
+				self.failures[shard_id] += 1
+				delay = min(300, self.identify_interval * 2 ** self.failures[shard_id])
+				log.write('shard %d exited with %s, restarting in %ds' % (shard_id, process.exitcode, delay))
+				self.restart_at[shard_id] = now + delay
+			elif now >= restart_at:
+				del self.restart_at[shard_id]
+				self._start(shard_id)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+
+import config
+import dispatch
+
+class MockBot:
+	def __init__(self, loop):
+		self.loop = loop
+		self.errors = []
+
+	def spawn(self, coro):
+		task = asyncio.ensure_future(coro, loop=self.loop)
+		task.add_done_callback(self._task_done)
+		return task
+
+	def _task_done(self, task):
+		if not task.cancelled() and task.exception() is not None:
+			self.errors.append(task.exception())
+
+	async def create_message(self, channel_id, text, embed=None):
+		raise Exception('403 Forbidden')
+
+	def report_error(self, raw_data, *args):
+		self.errors.append(raw_data)
+
+class MockCmd:
+	def __init__(self):
+		self.channel_id = '1'
+		self.sender = {'username': 'testname'}
+		self.cancelled = False
+
+def slow(cmd):
+	time.sleep(0.3)
+
+def test_worker_survives_failed_timeout_reply():
+	config.bot.dispatch = {'workers': 2, 'queue_size': 10, 'timeout': 0.05}
+	loop = asyncio.new_event_loop()
+	bot = MockBot(loop)
+	dispatcher = dispatch.Dispatcher(bot)
+	ran = []
+
+	async def run():
+		dispatcher.start()
+		for _ in range(3):
+			dispatcher.submit('slow', slow, MockCmd(), {})
+		await asyncio.sleep(0.5)
+		dispatcher.submit('fast', ran.append, MockCmd(), {})
+		await asyncio.sleep(0.2)
+		live = [worker for worker in dispatcher.workers if not worker.done()]
+		for worker in dispatcher.workers:
+			worker.cancel()
+		await asyncio.gather(*dispatcher.workers, return_exceptions=True)
+		return live
+
+	live = loop.run_until_complete(run())
+	dispatcher.executor.shutdown()
+	loop.close()
+	assert len(live) == 2, live
+	assert ran
+	assert dispatcher.pending == 0
+	assert len(bot.errors) == 3 # the timed out replies
+
+if __name__ == '__main__':
+	test_worker_survives_failed_timeout_reply()
+	print('ok')
@@ -0,0 +1,166 @@
+import asyncio
+from collections import defaultdict
+import datetime
+import heapq
+
+import config
+import log
+import metrics
+import utils
+
+# timers live in config.state:
+#   timers: {channel id: {name: {'time': datetime, 'every': seconds or None}}}
+#   reminders: {user id: [{'time': datetime, 'channel': channel id, 'text': text, 'dm': True if in a DM}]}
+# the scheduler keeps a min-heap of (fire time, seq, key) over them. deleting or rescheduling only
+# forgets the key's current entry; stale entries are skipped when they reach the top of the heap
+# and the heap is rebuilt once they outnumber the live ones
+
+warning = datetime.timedelta(hours=1) # timers are announced this long before they go off
+
+class Scheduler:
+	def __init__(self, bot):
+		self.bot = bot
+		self.heap = []
+		self.live = {} # key -> its current heap entry
+		self.seq = 0
+		self.event = asyncio.Event()
+		# channel id -> keys to schedule once that channel's guild shows up on this shard
+		self.unloaded = defaultdict(list)
+		_migrate()
+		for channel_id, timers in config.state.timers.items():
+			for name in timers:
+				self.unloaded[channel_id].append(timer_key(channel_id, name))
+		for user_id, reminders in config.state.reminders.items():
+			for reminder in reminders:
+				key = reminder_key(user_id, reminder)
+				if reminder.get('dm'):
+					# DMs go to shard 0 and don't belong to any guild
+					if bot.shard_id == 0:
+						self._schedule(key)
+				else:
+					self.unloaded[reminder['channel']].append(key)
+
+	def load(self, channel_ids):
+		for channel_id in channel_ids:
+			for key in self.unloaded.pop(channel_id, ()):
+				self._schedule(key)
+
+	# add and remove are called from command threads after changing config.state
+
+	def add(self, key):
+		self.bot.loop.call_soon_threadsafe(self._schedule, key)
+
+	def remove(self, key):
+		self.bot.loop.call_soon_threadsafe(self._cancel, key)
+
+	def _schedule(self, key):
+		entry = _lookup(key)
+		if entry is None:
+			self._cancel(key)
+			return
+		now = datetime.datetime.utcnow()
+		when = entry['time']
+		if key[0] == 'timer' and when - warning > now:
+			when -= warning
+		self._push(key, when)
+
+	def _push(self, key, when):
+		self.seq += 1
+		item = (when, self.seq, key)
+		self.live[key] = item
+		heapq.heappush(self.heap, item)
+		if self.heap[0] is item:
+			self.event.set()
+		if len(self.heap) > 2 * len(self.live) + 64:
+			self.heap = list(self.live.values())
+			heapq.heapify(self.heap)
+
+	def _cancel(self, key):
+		self.live.pop(key, None)
+
+	def _pop_stale(self):
+		while self.heap and self.live.get(self.heap[0][2]) is not self.heap[0]:
+			heapq.heappop(self.heap)
+
+	async def run(self):
+		while True:
+			with metrics.Timer(metrics.poller_seconds, 'timers'):
+				now = datetime.datetime.utcnow()
+				self._pop_stale()
+				while self.heap and self.heap[0][0] <= now:
+					_, _, key = heapq.heappop(self.heap)
+					del self.live[key]
+					try:
+						await self._fire(key, now)
+					except Exception:
+						self.bot.report_error('timer %r' % (key,))
+					self._pop_stale()
+				timeout = None
+				if self.heap:
+					timeout = (self.heap[0][0] - now).total_seconds()
+			try:
+				await asyncio.wait_for(self.event.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
+			self.event.clear()
+
+	async def _fire(self, key, now):
+		entry = _lookup(key)
+		if entry is None:
+			return
+		if key[0] == 'reminder':
+			_, user_id, _, _ = key
+			await self.bot.create_message(entry['channel'], '<@!%s>: %s' % (user_id, entry['text']))
+			reminders = list(config.state.reminders[user_id])
+			reminders.remove(entry)
+			if reminders:
+				config.state.put(('reminders', user_id), reminders)
+				if _lookup(key) is not None: # the same reminder set twice
+					self._schedule(key)
+			else:
+				config.state.delete(('reminders', user_id))
+			return
+
+		_, channel_id, name = key
+		dt = entry['time']
+		if dt > now:
+			await self.bot.create_message(channel_id, '%s until %s' % (utils.readable_rel(dt - now), name))
+			self._push(key, dt)
+			return
+		if entry['every'] is None:
+			await self.bot.create_message(channel_id, 'removing expired timer "%s" for %s' %
+					(name, dt.strftime(utils.dt_format)))
+			config.state.delete(('timers', channel_id, name))
+			return
+		every = datetime.timedelta(seconds=entry['every'])
+		# skip any occurrences missed while the bot was down
+		next_time = dt + every * ((now - dt) // every + 1)
+		config.state.put(('timers', channel_id, name, 'time'), next_time)
+		await self.bot.create_message(channel_id, '"%s" is up; next at %s' % (name, next_time.strftime(utils.dt_format)))
+		self._schedule(key)
+
+def timer_key(channel_id, name):
+	return ('timer', channel_id, name)
+
+def reminder_key(user_id, reminder):
+	return ('reminder', user_id, reminder['time'], reminder['text'])
+
+def _lookup(key):
+	if key[0] == 'timer':
+		_, channel_id, name = key
+		return config.state.timers.get(channel_id, {}).get(name)
+	_, user_id, dt, text = key
+	for reminder in config.state.reminders.get(user_id, ()):
+		if reminder['time'] == dt and reminder['text'] == text:
+			return reminder
+	return None
+
+def _migrate():
+	# timers used to be {name: datetime}, all in timer_channel
+	old = {name: dt for name, dt in config.state.timers.items() if isinstance(dt, datetime.datetime)}
+	if not old:
+		return
+	for name, dt in old.items():
+		config.state.delete(('timers', name))
+		config.state.put(('timers', config.bot.timer_channel, name), {'time': dt, 'every': None})
+	log.write('moved %d timers to channel %s' % (len(old), config.bot.timer_channel))
@@ -6,20 +6,16 @@ import urllib.parse
 
 import dateutil.parser
 import dateutil.tz
-import requests
 
 import config
-
-rs = requests.Session()
-rs.headers['User-Agent'] = 'sbot (github.com/raylu/sbot)'
+import httpclient
+import timers
 
 def help(cmd):
 	if cmd.args: # only reply on "!help"
 		return
 	commands = set(cmd.bot.commands.keys())
 	guild_id = cmd.bot.channels[cmd.channel_id]
-	if cmd.channel_id != config.bot.timer_channel:
-		commands.remove('timer')
 	if guild_id != config.bot.role_server:
 		for name, func in cmd.bot.commands.items():
 			if func.__module__ == 'management':
@@ -30,7 +26,7 @@ def help(cmd):
 def calc(cmd):
 	if not cmd.args:
 		return
-	response = rs.get('https://www.calcatraz.com/calculator/api', params={'c': cmd.args})
+	response = httpclient.get('https://www.calcatraz.com/calculator/api', params={'c': cmd.args})
 	if response.status_code == 200:
 		cmd.reply(response.text.rstrip()[:1000])
 	else:
@@ -64,7 +60,7 @@ def units(cmd):
 
 def roll(cmd):
 	args = cmd.args or '1d6'
-	response = rs.get('https://rolz.org/api/?' + urllib.parse.quote_plus(args))
+	response = httpclient.get('https://rolz.org/api/?' + urllib.parse.quote_plus(args))
 	split = response.text.split('\n')
 	details = split[2].split('=', 1)[1].strip()
 	details = details.replace(' +', ' + ').replace(' +  ', ' + ')
@@ -93,7 +89,7 @@ def timezones(cmd):
 			dt.astimezone(korean), dt.astimezone(australian))
 	cmd.reply(response)
 
-timer_usage = 'usage: `!timer list`, `!timer add thing in 1d2h3m`, `!timer del thing`'
+timer_usage = 'usage: `!timer list`, `!timer add thing in 1d2h3m [every 7d]`, `!timer del thing`'
 dt_format = '%Y-%m-%d %H:%M:%S'
 def timer(cmd):
 	if not cmd.args:
@@ -112,11 +108,17 @@ def timer(cmd):
 
 def _timer_list(cmd, split):
 	now = datetime.datetime.utcnow()
+	channel_timers = config.state.timers.get(cmd.channel_id, {})
 	reply = []
-	for name, time in config.state.timers.items():
+	for name, timer in sorted(channel_timers.items(), key=lambda item: item[1]['time']):
+		time = timer['time']
 		rel = readable_rel(time - now)
-		reply.append('%s: %s (%s)' % (name, time.strftime(dt_format), rel))
-	cmd.reply('\n'.join(reply))
+		if timer['every'] is None:
+			reply.append('%s: %s (%s)' % (name, time.strftime(dt_format), rel))
+		else:
+			every = readable_rel(datetime.timedelta(seconds=timer['every']))
+			reply.append('%s: %s (%s), every %s' % (name, time.strftime(dt_format), rel, every))
+	cmd.reply('\n'.join(reply) or 'no timers in this channel')
 
 def _timer_add(cmd, split):
 	try:
@@ -127,34 +129,31 @@ def _timer_add(cmd, split):
 	except ValueError:
 		cmd.reply('%s: must specify timer name and time delta' % cmd.sender['username'])
 		return
-	if name in config.state.timers:
-		time_str = config.state.timers[name].strftime(dt_format)
+	channel_timers = config.state.timers.get(cmd.channel_id, {})
+	if name in channel_timers:
+		time_str = channel_timers[name]['time'].strftime(dt_format)
 		cmd.reply('%s: "%s" already set for %s' % (cmd.sender['username'], name, time_str))
 		return
-	td_args = {'days': 0, 'hours': 0, 'minutes': 0}
-	for char, unit in zip('dhm', ['days', 'hours', 'minutes']):
-		try:
-			n_units, arg = arg.split(char, 1)
-		except ValueError:
-			continue
-		try:
-			td_args[unit] = int(n_units)
-		except ValueError:
-			cmd.reply('%s: "%s" not an int for unit %s' % (cmd.sender['username'], n_units, unit))
+	every = None
+	if ' every ' in arg:
+		arg, every_arg = arg.split(' every ', 1)
+		every = _parse_delta(cmd, every_arg)
+		if every is None:
 			return
-	if arg:
-		cmd.reply('%s: "%s" left over after parsing time' % (cmd.sender['username'], arg))
+		if every < datetime.timedelta(minutes=1):
+			cmd.reply('%s: timers can repeat at most once a minute' % cmd.sender['username'])
+			return
+		every = int(every.total_seconds())
+	td = _parse_delta(cmd, arg)
+	if td is None:
 		return
 	try:
-		td = datetime.timedelta(**td_args)
 		time = datetime.datetime.utcnow() + td
 	except OverflowError:
 		cmd.reply('%s: time not in range' % cmd.sender['username'])
 		return
-	config.state.timers[name] = time
-	config.state.save()
-	with cmd.bot.timer_condvar:
-		cmd.bot.timer_condvar.notify()
+	config.state.put(('timers', cmd.channel_id, name), {'time': time, 'every': every})
+	cmd.bot.timers.add(timers.timer_key(cmd.channel_id, name))
 	cmd.reply('"%s" set for %s (%s)' % (name, time.strftime(dt_format), readable_rel(td)))
 
 def _timer_del(cmd, split):
@@ -163,12 +162,80 @@ def _timer_del(cmd, split):
 	except IndexError:
 		cmd.reply('%s: missing args to `del`; %s' % (cmd.sender['username'], timer_usage))
 		return
-	try:
-		del config.state.timers[name]
-		config.state.save()
-		cmd.reply('deleted "%s"' % name)
-	except KeyError:
+	if not config.state.delete(('timers', cmd.channel_id, name)):
 		cmd.reply('%s: couldn\'t find "%s"' % (cmd.sender['username'], name))
+		return
+	cmd.bot.timers.remove(timers.timer_key(cmd.channel_id, name))
+	cmd.reply('deleted "%s"' % name)
+
+remind_usage = 'usage: `!remind 1d2h3m text`, `!remind list`, `!remind del 2`'
+def remind(cmd):
+	user_id = cmd.sender['id']
+	split = cmd.args.split(' ', 1)
+	reminders = list(config.state.reminders.get(user_id, []))
+	if split[0] == 'list':
+		now = datetime.datetime.utcnow()
+		reply = []
+		for i, reminder in enumerate(reminders, 1):
+			reply.append('%d. %s (%s): %s' % (i, reminder['time'].strftime(dt_format),
+					readable_rel(reminder['time'] - now), reminder['text']))
+		cmd.reply('\n'.join(reply) or '%s: no reminders' % cmd.sender['username'])
+		return
+	if split[0] == 'del':
+		try:
+			reminder = reminders[int(split[1]) - 1]
+		except (IndexError, ValueError):
+			cmd.reply('%s: %s' % (cmd.sender['username'], remind_usage))
+			return
+		reminders.remove(reminder)
+		if reminders:
+			config.state.put(('reminders', user_id), reminders)
+		else:
+			config.state.delete(('reminders', user_id))
+		cmd.bot.timers.remove(timers.reminder_key(user_id, reminder))
+		cmd.reply('deleted reminder "%s"' % reminder['text'])
+		return
+
+	if len(split) < 2:
+		cmd.reply(remind_usage)
+		return
+	td = _parse_delta(cmd, split[0])
+	if td is None:
+		return
+	try:
+		time = datetime.datetime.utcnow() + td
+	except OverflowError:
+		cmd.reply('%s: time not in range' % cmd.sender['username'])
+		return
+	reminder = {'time': time, 'channel': cmd.channel_id, 'text': split[1]}
+	if cmd.guild_id is None:
+		reminder['dm'] = True # there's no GUILD_CREATE to schedule it on after a restart
+	reminders.append(reminder)
+	reminders.sort(key=lambda r: r['time'])
+	config.state.put(('reminders', user_id), reminders)
+	cmd.bot.timers.add(timers.reminder_key(user_id, reminder))
+	cmd.reply('%s: reminding you at %s (%s)' % (cmd.sender['username'], time.strftime(dt_format), readable_rel(td)))
+
+def _parse_delta(cmd, arg):
+	td_args = {'days': 0, 'hours': 0, 'minutes': 0}
+	for char, unit in zip('dhm', ['days', 'hours', 'minutes']):
+		try:
+			n_units, arg = arg.split(char, 1)
+		except ValueError:
+			continue
+		try:
+			td_args[unit] = int(n_units)
+		except ValueError:
+			cmd.reply('%s: "%s" not an int for unit %s' % (cmd.sender['username'], n_units, unit))
+			return None
+	if arg:
+		cmd.reply('%s: "%s" left over after parsing time' % (cmd.sender['username'], arg))
+		return None
+	try:
+		return datetime.timedelta(**td_args)
+	except OverflowError:
+		cmd.reply('%s: time not in range' % cmd.sender['username'])
+		return None
 
 def readable_rel(rel):
 	seconds = rel.total_seconds()
@@ -192,7 +259,7 @@ def weather(cmd):
 		return
 	url = 'https://api.wunderground.com/api/%s/conditions/q/%s.json' % (
 			config.bot.weather_key, urllib.parse.quote_plus(cmd.args.replace(' ', '_')))
-	response = rs.get(url)
+	response = httpclient.get(url)
 	response.raise_for_status()
 	data = response.json()
 	if 'current_observation' in data:
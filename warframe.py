@@ -1,7 +1,7 @@
-import requests
+import httpclient
 
 def alert_analysis():
-	r = requests.get('http://content.warframe.com/dynamic/worldState.php')
+	r = httpclient.get('http://content.warframe.com/dynamic/worldState.php')
 	r.raise_for_status()
 	warframe_state = r.json()
 
@@ -0,0 +1,142 @@
+import asyncio
+from collections import defaultdict
+import time
+
+import config
+import log
+import sde
+
+# routes zkillboard kills to channels. each subscription in config.bot.zkillboard names a channel
+# and any of alliances, corporations, characters (involved on either side), ship_types (the
+# victim's), regions and min_isk; a kill has to pass every filter a subscription sets. subscriptions
+# with digest: seconds collect their kills and post one summary per interval instead
+#
+# the entity filters are compiled into one hash index per kind, so a kill is matched by looking up
+# each participant once rather than by testing every subscription
+
+entity_kinds = (('alliances', 'alliance'), ('corporations', 'corporation'), ('characters', 'character'))
+
+class Subscription:
+	__slots__ = ('channel', 'ship_types', 'regions', 'min_isk', 'digest')
+
+	def __init__(self, conf):
+		self.channel = conf['channel']
+		self.ship_types = frozenset(conf.get('ship_types') or ())
+		self.regions = frozenset(conf.get('regions') or ())
+		self.min_isk = conf.get('min_isk') or 0
+		self.digest = conf.get('digest')
+
+class Subscriptions:
+	def __init__(self, bot, conf):
+		self.bot = bot
+		self.index = {kind: defaultdict(list) for _, kind in entity_kinds} # kind -> id -> subscriptions
+		self.unfiltered = [] # subscriptions with no entity filter
+		self.digests = {} # channel -> [due (monotonic), interval, kill lines, total isk]
+		self.digest_added = asyncio.Event()
+		self.subscriptions = []
+		for sub_conf in _subscription_confs(conf):
+			sub = Subscription(sub_conf)
+			self.subscriptions.append(sub)
+			entities = False
+			for key, kind in entity_kinds:
+				for entity_id in sub_conf.get(key) or ():
+					self.index[kind][entity_id].append(sub)
+					entities = True
+			if not entities:
+				self.unfiltered.append(sub)
+		self.system_regions = {}
+		if any(sub.regions for sub in self.subscriptions):
+			self.system_regions = _load_regions()
+
+	def match(self, killmail, value):
+		# returns channel -> digest interval (None to post right away) for the subscriptions that want
+		# this kill
+		candidates = {id(sub): sub for sub in self.unfiltered}
+		participants = killmail['attackers'] + [killmail['victim']]
+		for participant in participants:
+			for kind, ids in self.index.items():
+				if kind in participant:
+					for sub in ids.get(participant[kind]['id'], ()):
+						candidates[id(sub)] = sub
+		if not candidates:
+			return {}
+
+		ship_type = killmail['victim']['shipType']['id']
+		region = self.system_regions.get(killmail['solarSystem']['id'])
+		channels = {}
+		for sub in candidates.values():
+			if sub.ship_types and ship_type not in sub.ship_types:
+				continue
+			if sub.regions and region not in sub.regions:
+				continue
+			if value < sub.min_isk:
+				continue
+			if sub.channel in channels and channels[sub.channel] is None:
+				continue # already posting it right away
+			channels[sub.channel] = sub.digest
+		return channels
+
+	def post(self, data):
+		killmail = data['package']['killmail']
+		victim = killmail['victim']
+		if 'character' not in victim:
+			return
+		value = data['package']['zkb']['totalValue']
+		channels = self.match(killmail, value)
+		if not channels:
+			return
+
+		line = "%s's **%s** (%d mil) %s" % (victim['character']['name'], victim['shipType']['name'],
+				value / 1000000, 'https://zkillboard.com/kill/%d/' % killmail['killID'])
+		for channel, digest in channels.items():
+			if digest is None:
+				self.bot.spawn(self.bot.create_message(channel, line))
+				continue
+			pending = self.digests.get(channel)
+			if pending is None:
+				pending = self.digests[channel] = [time.monotonic() + digest, digest, [], 0]
+				self.digest_added.set()
+			pending[2].append(line)
+			pending[3] += value
+
+	async def run(self):
+		# posts each channel's digest when its interval is up
+		while True:
+			timeout = None
+			if self.digests:
+				timeout = max(0, min(pending[0] for pending in self.digests.values()) - time.monotonic())
+			try:
+				await asyncio.wait_for(self.digest_added.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
+			self.digest_added.clear()
+			now = time.monotonic()
+			for channel, (due, interval, lines, total) in list(self.digests.items()):
+				if due > now:
+					continue
+				del self.digests[channel]
+				self.bot.spawn(self.bot.create_message(channel, _digest_message(interval, lines, total)))
+
+def _digest_message(interval, lines, total):
+	period = '%d minutes' % (interval // 60) if interval >= 60 else '%d seconds' % interval
+	header = '**%d kills** (%d mil) in the last %s:' % (len(lines), total / 1000000, period)
+	message = header
+	for i, line in enumerate(lines):
+		more = '\nand %d more' % (len(lines) - i)
+		if len(message) + 1 + len(line) + len(more) > 2000:
+			return message + more
+		message += '\n' + line
+	return message
+
+def _subscription_confs(conf):
+	if 'subscriptions' in conf:
+		return conf['subscriptions']
+	# the old single alliance -> channel form
+	return [{'channel': conf['channel'], 'alliances': [conf['alliance']]}]
+
+def _load_regions():
+	if config.bot.eve_db is None:
+		log.write('zkill: region filters need eve_db; they will match nothing')
+		return {}
+	sde_file = sde.load(config.bot.eve_db, config.bot.eve_sde)
+	return dict(zip(sde_file.system_ids, sde_file.system_regions))